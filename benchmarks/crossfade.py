@@ -0,0 +1,80 @@
+"""Cost of mixing crossfades, with every stream fading at once.
+
+Each stream is a CrossfadeSource over two sources of generated frames,
+started at the beginning of its fade. One tick reads a frame from every
+stream, the way the players do every 20 ms. The report is the time per
+mixed frame and per tick, against the 20 ms a tick can take at most.
+
+    python -m benchmarks.crossfade [streams] [ticks]
+"""
+
+from __future__ import annotations
+
+import random, sys, time
+
+import discord
+
+from utils.dsp import CrossfadeSource
+from utils.track import Track
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class Frames(discord.AudioSource):
+    """Plays a few prepared frames in a loop, like a song of ``duration``
+    seconds.
+    """
+    def __init__(self, rng: random.Random, duration: int):
+        self.frames = [
+            bytes(rng.getrandbits(8) for _ in range(FRAME_SIZE))
+            for _ in range(4)
+        ]
+        self.track = Track('https://example.com/', duration=duration)
+        self.read_frames = 0
+
+    @property
+    def position(self) -> float:
+        return self.read_frames * FRAME_LENGTH
+
+    def read(self) -> bytes:
+        self.read_frames += 1
+        return self.frames[self.read_frames % len(self.frames)]
+
+    def is_opus(self) -> bool:
+        return False
+
+
+def main() -> None:
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+
+    rng = random.Random(0)
+    # Fades long enough to last the whole run.
+    length = ticks * FRAME_LENGTH + 1
+    sources = []
+    for _ in range(streams):
+        upcoming = Frames(rng, 180)
+        sources.append(
+            CrossfadeSource(Frames(rng, round(length)), length,
+                            lambda upcoming=upcoming: upcoming))
+
+    worst = 0.0
+    start = time.perf_counter()
+    for _ in range(ticks):
+        tick = time.perf_counter()
+        for source in sources:
+            source.read()
+        worst = max(worst, time.perf_counter() - tick)
+    elapsed = time.perf_counter() - start
+
+    assert all(source.fading for source in sources)
+    per_tick = elapsed / ticks
+    print('{} streams: {:.1f} us per mixed frame, {:.2f} ms per tick '
+          '({:.1%} of a frame), worst tick {:.2f} ms'.format(
+              streams, per_tick / streams * 1e6, per_tick * 1000,
+              per_tick / FRAME_LENGTH, worst * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Memory allocated per frame by the PCM playback path.
+
+Reads a generated tone from FFmpeg, the way a guild in PCM mode does:
+FFmpegPCMAudio and PCMVolumeTransformer as discord.py ships them, then
+PooledPCMAudio and the DSP stage (PCMVolumeTransformer when NumPy isn't
+installed). Streams are read in turns from one thread, the way the audio
+scheduler does, and frames are handed back after use the way
+BufferedAudioSource does.
+
+tracemalloc's peak is reset before every read, what the read allocated
+shows up as the peak over what was allocated before it. Frame buffers
+counts the buffers behind the frames that were read.
+
+    python -m benchmarks.frame_alloc [streams] [seconds]
+"""
+
+from __future__ import annotations
+
+import sys, tracemalloc
+
+import discord
+
+from utils.dsp import transform
+from utils.frames import FramePool, PooledPCMAudio
+
+TONE = 'sine=frequency=440:sample_rate=48000:duration={}'
+
+
+def plain(seconds: int, pool: FramePool) -> discord.AudioSource:
+    return discord.FFmpegPCMAudio(TONE.format(seconds),
+                                  before_options='-f lavfi')
+
+
+def pooled(seconds: int, pool: FramePool) -> discord.AudioSource:
+    return PooledPCMAudio(TONE.format(seconds),
+                          pool=pool,
+                          before_options='-f lavfi')
+
+
+class Lender(discord.AudioSource):
+    """Hands the frames of a reader on and gives each back once the next
+    one is read, like BufferedAudioSource without its thread.
+    """
+    def __init__(self, reader: discord.AudioSource):
+        self.reader = reader
+        self.release = getattr(reader, 'release', None)
+        self.lent = None
+        self.buffers = set()
+
+    def read(self) -> bytes:
+        data = self.reader.read()
+        if self.release is not None and self.lent is not None:
+            self.release(self.lent)
+        self.lent = data
+        if data:
+            self.buffers.add(id(data))
+        return data
+
+    def is_opus(self) -> bool:
+        return False
+
+
+def run(reader, volume, streams: int, seconds: int):
+    pool = FramePool()
+    pipelines = []
+    for _ in range(streams):
+        lender = Lender(reader(seconds, pool))
+        pipelines.append((lender, volume(lender)))
+
+    frames = 0
+    allocated = 0
+    tracemalloc.start()
+    # Fresh bytes objects would get the ids of freed ones, the frames read
+    # are kept alive so that every buffer is counted.
+    kept = []
+    active = list(pipelines)
+    while active:
+        for pipeline in list(active):
+            lender, source = pipeline
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            data = source.read()
+            _, peak = tracemalloc.get_traced_memory()
+            if not data:
+                active.remove(pipeline)
+                continue
+
+            frames += 1
+            allocated += peak - before
+            if isinstance(lender.lent, bytes):
+                kept.append(lender.lent)
+    tracemalloc.stop()
+
+    # The pool is shared, a buffer can have been read by several streams.
+    buffers = len(set().union(*(lender.buffers for lender, _ in pipelines)))
+    for lender, source in pipelines:
+        source.cleanup()
+    return allocated / frames, buffers / streams, frames / streams
+
+
+def main() -> None:
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+    shapes = (
+        ('ffmpeg + volume', plain,
+         lambda source: discord.PCMVolumeTransformer(source, 0.5)),
+        ('pooled + dsp', pooled, lambda source: transform(source, 0.5)),
+    )
+    for name, reader, volume in shapes:
+        per_frame, buffers, frames = run(reader, volume, streams, seconds)
+        print('{:<16} {:>8.1f} bytes per frame  {:>6.1f} frame buffers per '
+              'stream ({:.0f} frames)'.format(name, per_frame, buffers,
+                                              frames))
+
+
+if __name__ == '__main__':
+    main()
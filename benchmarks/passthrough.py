@@ -0,0 +1,88 @@
+"""CPU cost per stream of the PCM and the Opus passthrough playback paths.
+
+Both paths decode the same generated tone with FFmpeg. The PCM path then
+scales every frame with PCMVolumeTransformer and encodes it with the
+bundled Opus encoder, the way VoiceClient does. The passthrough path lets
+FFmpeg apply the volume and encode, and only reads the packets.
+
+Frames are read as fast as possible, the result is the CPU time (bot
+process and FFmpeg) spent per minute of audio and stream.
+
+    python -m benchmarks.passthrough [streams] [seconds]
+"""
+
+from __future__ import annotations
+
+import resource, sys, threading, time
+
+import discord
+
+TONE = 'sine=frequency=440:sample_rate=48000:duration={}'
+
+
+def cpu_time() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime + children.ru_utime +
+            children.ru_stime)
+
+
+def pcm_stream(seconds: int) -> None:
+    source = discord.PCMVolumeTransformer(
+        discord.FFmpegPCMAudio(TONE.format(seconds),
+                               before_options='-f lavfi'), 0.5)
+    encoder = discord.opus.Encoder()
+    while True:
+        data = source.read()
+        if not data:
+            break
+        encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+    source.cleanup()
+
+
+def opus_stream(seconds: int) -> None:
+    source = discord.FFmpegOpusAudio(TONE.format(seconds),
+                                     before_options='-f lavfi',
+                                     options='-af volume=0.5')
+    while source.read():
+        pass
+    source.cleanup()
+
+
+def run(target, streams: int, seconds: int) -> float:
+    errors = []
+
+    def stream() -> None:
+        try:
+            target(seconds)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=stream) for _ in range(streams)]
+    start = cpu_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        # A stream that failed, FFmpeg missing for one, cost next to nothing.
+        raise errors[0]
+    # cleanup() waits for FFmpeg, so its CPU time has been accounted for.
+    return (cpu_time() - start) / streams / (seconds / 60)
+
+
+def main() -> None:
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+
+    discord.opus._load_default()
+    for name, target in (('pcm', pcm_stream), ('passthrough', opus_stream)):
+        start = time.perf_counter()
+        cost = run(target, streams, seconds)
+        print('{:<12} {:>8.3f} CPU s per stream-minute  ({:.1f}s wall)'.format(
+            name, cost,
+            time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
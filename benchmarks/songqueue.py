@@ -0,0 +1,73 @@
+"""Cost of positional queue operations on a long queue.
+
+Compares the deque the song queue used to keep its songs in with the
+IndexedList it uses now. Every operation runs at random positions of a
+queue of ``size`` songs, the result is the average time per operation.
+
+    python -m benchmarks.songqueue [size] [operations]
+"""
+
+from __future__ import annotations
+
+import collections, random, sys, time
+
+from utils.indexedlist import IndexedList
+
+
+def deque_move(queue: collections.deque, source: int, destination: int):
+    item = queue[source]
+    del queue[source]
+    queue.insert(destination, item)
+
+
+def deque_range(queue: collections.deque, start: int, stop: int):
+    queue.rotate(-start)
+    for _ in range(stop - start):
+        queue.popleft()
+    queue.rotate(start)
+
+
+def list_range(queue: IndexedList, start: int, stop: int):
+    queue.delete_range(start, stop)
+
+
+OPERATIONS = {
+    'index': (lambda q, i, j: q[i], lambda q, i, j: q[i]),
+    'insert': (lambda q, i, j: q.insert(i, None),
+               lambda q, i, j: q.insert(i, None)),
+    'remove': (lambda q, i, j: q.__delitem__(i),
+               lambda q, i, j: q.__delitem__(i)),
+    'move': (deque_move, lambda q, i, j: q.move(i, j)),
+    'remove_range': (lambda q, i, j: deque_range(q, i, i + 10),
+                     lambda q, i, j: list_range(q, i, i + 10)),
+}
+
+
+def run(queue, operation, size: int, count: int) -> float:
+    rng = random.Random(0)
+    positions = [(rng.randrange(size // 2), rng.randrange(size // 2))
+                 for _ in range(count)]
+    start = time.perf_counter()
+    for i, j in positions:
+        operation(queue, i, j)
+    return (time.perf_counter() - start) / count
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    print('{:<14} {:>12} {:>12}'.format('operation', 'deque', 'indexed'))
+    for name, (on_deque, on_list) in OPERATIONS.items():
+        results = []
+        for queue in (collections.deque(range(size)),
+                      IndexedList(range(size))):
+            operation = on_deque if isinstance(queue,
+                                               collections.deque) else on_list
+            results.append(run(queue, operation, size, count))
+        print('{:<14} {:>10.2f}us {:>10.2f}us'.format(
+            name, *(result * 1e6 for result in results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Memory held per queued song by its track info.
+
+Builds a queue of songs whose info looks like what youtube_dl returns for
+a YouTube video, and measures it with tracemalloc in three shapes: the
+full info dict the queue used to hold, the slim dict the extraction cache
+kept, and the Track it holds now. The songs share a few uploaders, as the
+songs of a playlist do.
+
+    python -m benchmarks.track_memory [songs]
+"""
+
+from __future__ import annotations
+
+import gc, random, sys, tracemalloc
+
+from utils.cache import slim_info
+from utils.track import Track
+
+
+def info_dict(n: int, rng: random.Random) -> dict:
+    """A youtube_dl info dict, with about as many formats and thumbnails as
+    a music video has.
+    """
+    video_id = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789-_')
+                       for _ in range(11))
+    uploader = 'Uploader {}'.format(n % 25)
+    return {
+        'id': video_id,
+        'title': 'Song number {} - Official Music Video'.format(n),
+        'uploader': uploader,
+        'uploader_id': 'UC' + 'x' * 22,
+        'uploader_url': 'http://www.youtube.com/user/' + uploader.replace(
+            ' ', ''),
+        'upload_date': '20{:02d}0{}1{}'.format(n % 20, n % 9 + 1, n % 10),
+        'thumbnail': 'https://i.ytimg.com/vi/{}/maxresdefault.jpg'.format(
+            video_id),
+        'description': 'Lyrics, credits and links. ' * 40,
+        'duration': 180 + n % 120,
+        'tags': ['music', 'official', 'video', uploader, 'song {}'.format(n)],
+        'categories': ['Music'],
+        'webpage_url': 'https://www.youtube.com/watch?v=' + video_id,
+        'view_count': rng.randrange(10**9),
+        'like_count': rng.randrange(10**7),
+        'dislike_count': rng.randrange(10**5),
+        'url': 'https://rr1---sn.googlevideo.com/videoplayback?expire=1700000000'
+        '&id={}&itag=251&sig={}'.format(video_id, 'A' * 120),
+        'formats': [{
+            'format_id': str(itag),
+            'url': 'https://rr1---sn.googlevideo.com/videoplayback?itag={}'
+            '&sig={}'.format(itag, 'B' * 120),
+            'ext': 'webm',
+            'acodec': 'opus',
+            'vcodec': 'none',
+            'abr': 160,
+            'filesize': rng.randrange(10**7),
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0',
+                'Accept': '*/*'
+            },
+        } for itag in range(20)],
+        'thumbnails': [{
+            'url': 'https://i.ytimg.com/vi/{}/{}.jpg'.format(video_id, i),
+            'width': 120 * i,
+            'height': 90 * i,
+        } for i in range(1, 6)],
+    }
+
+
+def measure(build, songs: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    queue = [build(n) for n in range(songs)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del queue
+    return current // songs
+
+
+def main() -> None:
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    # Every song gets freshly extracted info, only what the queue keeps of
+    # it is counted.
+    shapes = (
+        ('info dict', lambda n: info_dict(n, random.Random(n))),
+        ('slim dict', lambda n: slim_info(info_dict(n, random.Random(n)))),
+        ('Track', lambda n: Track.from_info(info_dict(n, random.Random(n)))),
+    )
+
+    full = None
+    for name, build in shapes:
+        size = measure(build, songs)
+        full = full or size
+        print('{:<10} {:>8} bytes per song  ({:.1%})'.format(
+            name, size, size / full))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,47 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import annotations
+
 import asyncio
+import collections
 import functools
-import itertools
+import logging
 import math
-import random
+import os
+import re
+import threading
+import time
+import typing
 
 import discord
-import youtube_dl
 
 from core import Bot, Context, Cog
 
-from discord.ext import commands
-
-# Silence useless bug reports messages
-youtube_dl.utils.bug_reports_message = lambda: ''
+from discord.ext import commands, menus, tasks
+
+from utils.audio import FRAME_LENGTH, BufferedAudioSource
+from utils.audiocache import AudioCache
+from utils.audioscheduler import AudioScheduler
+from utils.cache import ExtractionCache, SingleFlight, normalize_query, stream_expiry
+from utils import dsp
+from utils.dsp import EQ_PRESETS, CrossfadeSource, DSPAudioSource, ffmpeg_filters, transform
+from utils.frames import FramePool, PooledPCMAudio
+from utils.indexedlist import IndexedList
+from utils.loudness import (LoudnessAnalyzer, loudnorm_filter, track_gain,
+                            track_level)
+from utils.opusstore import OpusFrameStore, MmapOpusSource
+from utils.robopages import RoboPages
+from utils.extractor import ExtractionPool, ExtractionError
+from utils.scheduler import FairScheduler, OrderedPipeline, AdmissionError
+from utils.sessions import QueueUpdate, SessionStore
+from utils.track import Track
+from utils.trackstore import TrackStore
+
+log = logging.getLogger(__name__)
+
+# Timestamps taken by the seek commands, see YTDLSource.parse_timestamp.
+_CLOCK = re.compile(r'(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)')
+_UNITS = re.compile(r'(?:(\d+)h)?(?:(\d+)m)?(?:(\d+(?:\.\d+)?)s?)?')
 
 
 class VoiceError(Exception):
@@ -25,7 +52,7 @@ class YTDLError(Exception):
     pass
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
+class YTDLSource(discord.AudioSource):
     YTDL_OPTIONS = {
         'format': 'bestaudio/best',
         'extractaudio': True,
@@ -48,93 +75,500 @@ class YTDLSource(discord.PCMVolumeTransformer):
         'options': '-vn',
     }
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+    # Stream URLs are refreshed when they would expire within the song's
+    # duration plus this many seconds.
+    REFRESH_MARGIN = 60
+
+    # Let FFmpeg encode Opus and apply the volume itself, so that frames are
+    # sent as they are instead of being scaled and encoded in Python. The
+    # default of new players, set MUSIC_PASSTHROUGH=0 to decode to PCM
+    # instead; guilds can change it with the passthrough command.
+    PASSTHROUGH = os.environ.get('MUSIC_PASSTHROUGH', '1') != '0'
+    BITRATE = 128
+
+    # youtube_dl runs in its own worker processes, see utils/extractor.py
+    engine = ExtractionPool(YTDL_OPTIONS)
+    cache = ExtractionCache()
+    flights = SingleFlight()
+    # Track info that outlives restarts, without the stream URLs.
+    store = TrackStore('utils/tracks.db')
+    # Loudness measured once per track, kept with the track info.
+    analyzer = LoudnessAnalyzer(store)
+    # Popular tracks are played from disk instead of being streamed.
+    audio_cache = AudioCache('cache/audio')
+    # Their encoded frames, sent as they are without running FFmpeg.
+    frame_store = OpusFrameStore('cache/frames')
+    # PCM frames are read into recycled buffers, shared by every stream.
+    frame_pool = FramePool()
+    # Seconds from the last restarts (seeks, passthrough volume changes) to
+    # the first frame of their new process.
+    restart_latencies = collections.deque(maxlen=50)
+    # How far ahead of the position a restart starts its new process, until
+    # restart latencies have been measured.
+    RESTART_LEAD = 0.3
 
     def __init__(self,
-                 ctx: Context,
-                 source: discord.FFmpegPCMAudio,
+                 song: Song,
                  *,
-                 data: dict,
-                 volume: float = 0.5):
-        super().__init__(source, volume)
-
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
-
-        self.uploader = data.get('uploader')
-        self.uploader_url = data.get('uploader_url')
-        date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
-        self.title = data.get('title')
-        self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
-        self.url = data.get('webpage_url')
-        self.views = data.get('view_count')
-        self.likes = data.get('like_count')
-        self.dislikes = data.get('dislike_count')
-        self.stream_url = data.get('url')
+                 track: Track,
+                 volume: float = 0.5,
+                 passthrough: bool = PASSTHROUGH,
+                 eq: str = 'flat',
+                 path: str = None,
+                 start: float = 0.0):
+        self.requester = song.requester
+        self.channel = song.channel
+        self.track = track
+        self.stream_url = track.url
+        # Brings the track to the target loudness, None until it's measured.
+        self.gain = track_gain(track)
+        # A local copy from the audio cache, played instead of the stream.
+        self.path = path
+
+        self.passthrough = passthrough
+        self._volume = volume
+        self._eq = eq
+        # Playback position is counted in frames read since _offset.
+        self._offset = start
+        self._frames = 0
+        self._underruns = 0
+        self._pending: typing.Optional[_Restart] = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._source, self._buffer = self._open(start)
 
     def __str__(self):
-        return '**{0.title}** by **{0.uploader}**'.format(self)
+        return '**{0.title}** by **{0.uploader}**'.format(self.track)
+
+    def _open(
+        self, position: float
+    ) -> typing.Tuple[discord.AudioSource, discord.AudioSource]:
+        """Returns the source to play from ``position`` on and the buffer
+        it reads from.
+        """
+        if self.passthrough and self._eq == 'flat' and self.gain is not None:
+            frames = self.frame_store.lookup(self.track.webpage_url,
+                                             self.level)
+            if frames is not None:
+                # Seeking in stored frames is an index lookup.
+                buffer = MmapOpusSource(frames, start=position)
+                return buffer, buffer
+
+        if self.path is not None:
+            source, before_options = self.path, ''
+        else:
+            source = self.stream_url
+            before_options = self.FFMPEG_OPTIONS['before_options']
+
+        if position > 0:
+            before_options = '-ss {:.3f} {}'.format(position, before_options)
+
+        # FFmpeg is read ahead on another thread so that CDN stalls
+        # don't block the player. The audio scheduler's filler threads
+        # read for every guild it plays.
+        scheduler = VoiceState.audio_scheduler
+        filler = scheduler and scheduler.filler
+        if self.passthrough:
+            filters = 'volume={:.3f}'.format(self.level)
+            if self.gain is None:
+                # Not analyzed yet, FFmpeg estimates the loudness as it goes.
+                filters = '{},{}'.format(loudnorm_filter(), filters)
+            if self._eq != 'flat':
+                filters += ',' + ffmpeg_filters(self._eq)
+            buffer = BufferedAudioSource(
+                discord.FFmpegOpusAudio(
+                    source,
+                    bitrate=self.BITRATE,
+                    before_options=before_options,
+                    options='{} -af {}'.format(self.FFMPEG_OPTIONS['options'],
+                                               filters)),
+                filler=filler)
+            return buffer, buffer
+
+        # The volume and the equalizer are applied after the buffer to take
+        # effect right away.
+        buffer = BufferedAudioSource(
+            PooledPCMAudio(source,
+                           pool=self.frame_pool,
+                           before_options=before_options,
+                           options=self.FFMPEG_OPTIONS['options']),
+            filler=filler)
+        return transform(buffer, self._volume, eq=self._eq,
+                         gain=self.gain), buffer
+
+    @property
+    def level(self) -> float:
+        """The volume with the track gain applied."""
+        return track_level(self.track, self._volume)
+
+    @property
+    def position(self) -> float:
+        """Seconds of the song that have been played so far, or the position
+        of a seek that hasn't taken over yet.
+        """
+        pending = self._pending
+        if pending is not None and not pending.aligned:
+            return pending.position
+        return self._played
+
+    @property
+    def _played(self) -> float:
+        return self._offset + self._frames * FRAME_LENGTH
+
+    @property
+    def buffer_stats(self) -> typing.Dict[str, typing.Any]:
+        stats = self._buffer.stats
+        stats['underruns'] += self._underruns
+        return stats
+
+    @property
+    def dsp_stats(self) -> typing.Dict[str, typing.Any]:
+        if isinstance(self._source, DSPAudioSource):
+            return self._source.stats
+        return {}
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @property
+    def eq(self) -> str:
+        return self._eq
+
+    def _sources(self) -> typing.List[discord.AudioSource]:
+        # The playing source, and the one of a seek about to take over.
+        pending = self._pending
+        if pending is None:
+            return [self._source]
+        return [self._source, pending.source]
+
+    async def restart(self, position: float = None) -> None:
+        """Replaces the FFmpeg process with a new one starting at
+        ``position``, the current position by default.
+
+        The old process keeps playing until the new one has frames, so
+        there's no gap. Without ``position`` playback goes on where it is:
+        the new process starts ahead by about the time a restart takes, and
+        takes over once the old one has played up to there.
+        """
+        started = time.perf_counter()
+        aligned = position is None
+        if aligned:
+            latencies = self.restart_latencies
+            lead = (sum(latencies) /
+                    len(latencies) if latencies else self.RESTART_LEAD)
+            position = self._played + lead
+
+        # Starting FFmpeg blocks, like Broadcast._open.
+        loop = asyncio.get_running_loop()
+        source, buffer = await loop.run_in_executor(None, self._open, position)
+        restart = _Restart(source, buffer, position, aligned, started)
+        with self._lock:
+            if self._closed:
+                # Stopped while FFmpeg was starting.
+                replaced = restart
+            else:
+                replaced, self._pending = self._pending, restart
+        if replaced is not None:
+            _cleanup_later(replaced.source)
+
+    async def refresh_stream(self,
+                             position: float = None,
+                             *,
+                             volume: float = None,
+                             eq: str = None) -> None:
+        """Makes sure a restart at ``volume`` and ``eq``, the current ones
+        by default, can open the stream from ``position`` on, the current
+        position by default.
+
+        A source played from the frame store or found there by
+        ``create_source`` was never given a fresh stream URL, and a restart
+        at another volume or with an equalizer streams it. A restart the
+        frame store still serves doesn't need the stream.
+        """
+        volume = self._volume if volume is None else volume
+        eq = self._eq if eq is None else eq
+        if self.path is not None or self._stored(volume, eq):
+            return
+
+        if position is None:
+            position = self.position
+        if self.needs_refresh(self.track, position):
+            self.track = await self.refresh(self.track)
+            self.stream_url = self.track.url
+
+    def _stored(self, volume: float, eq: str) -> bool:
+        """Whether _open plays the track from the frame store with these
+        settings.
+        """
+        return (self.passthrough and eq == 'flat' and self.gain is not None
+                and self.frame_store.contains(self.track.webpage_url,
+                                              track_level(self.track, volume)))
+
+    async def configure(self, *, volume: float, eq: str) -> None:
+        """Sets the volume and the equalizer preset. Raises YTDLError,
+        leaving both as they were, if the stream a restart needs can't be
+        refreshed.
+        """
+        if volume == self._volume and eq == self._eq:
+            return
+
+        if self.passthrough:
+            # Both are FFmpeg filters, they take a new process.
+            await self.refresh_stream(volume=volume, eq=eq)
+            self._volume, self._eq = volume, eq
+            await self.restart()
+            return
+
+        self._volume, self._eq = volume, eq
+        for source in self._sources():
+            if isinstance(source, DSPAudioSource):
+                source.volume = volume
+                source.eq = eq
+            else:
+                source.volume = self.level
+
+    async def seek(self, position: float) -> None:
+        """Restarts playback at ``position`` with the stream URL already
+        resolved, it's only refreshed if it expires before the song ends.
+        FFmpeg seeks before opening the input, which for a stream is a
+        range request.
+        """
+        await self.refresh_stream(position)
+        await self.restart(position)
+
+    def _take_over(self, force: bool) -> None:
+        # Called from the player thread with the lock held.
+        pending = self._pending
+        if pending.ready_at is None and pending.buffer.ready():
+            pending.ready_at = time.perf_counter()
+            self.restart_latencies.append(pending.ready_at - pending.started)
+
+        if not force:
+            if pending.ready_at is None:
+                return
+            if (pending.aligned and self._played < pending.position
+                    and self._buffer.ready()):
+                return
+
+        if pending.aligned:
+            # Started late, the frames the old process has played already
+            # are skipped.
+            while (pending.position + FRAME_LENGTH <= self._played
+                   and pending.buffer.ready()):
+                if not pending.buffer.read():
+                    break
+                pending.position += FRAME_LENGTH
+
+        old = self._source
+        self._underruns += self._buffer.underruns
+        self._source, self._buffer = pending.source, pending.buffer
+        self._offset = pending.position
+        self._frames = 0
+        self._pending = None
+        _cleanup_later(old)
+
+    def read(self) -> bytes:
+        # Only the player thread swaps sources, the lock guards _pending
+        # against restarts. Reads block on the buffer and happen outside of
+        # it, a restart must not wait for a stalled stream.
+        with self._lock:
+            if self._pending is not None:
+                self._take_over(False)
+            source = self._source
+
+        data = source.read()
+        if not data:
+            with self._lock:
+                if self._pending is None:
+                    return data
+                # The old process ended first, the new one is waited for.
+                self._take_over(True)
+                source = self._source
+            data = source.read()
+
+        if data:
+            self._frames += 1
+        return data
+
+    def ready(self) -> bool:
+        pending = self._pending
+        return self._buffer.ready() or (pending is not None
+                                        and pending.buffer.ready())
+
+    def is_opus(self) -> bool:
+        return self.passthrough
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.source.cleanup()
+        self._source.cleanup()
 
     @classmethod
     async def create_source(cls,
-                            ctx: Context,
-                            search: str,
+                            song: Song,
                             *,
-                            loop: asyncio.BaseEventLoop = None):
-        loop = loop or asyncio.get_event_loop()
+                            volume: float = 0.5,
+                            passthrough: bool = PASSTHROUGH,
+                            eq: str = 'flat',
+                            start: float = 0.0):
+        """Opens the stream of a queued song, refreshing its URL if needed.
+        Playback begins ``start`` seconds into the song.
+        """
+        # The measured loudness is applied as gain, see utils/loudness.py.
+        song.track = await cls.analyzer.resolve(song.track)
+        level = track_level(song.track, volume)
+
+        # The frame store only keeps tracks as they are, at some volume, so
+        # tracks are stored once their loudness is known.
+        framed = (passthrough and eq == 'flat'
+                  and song.track.loudness is not None)
+        stored = framed and cls.frame_store.contains(song.url, level)
+        path = cls.audio_cache.lookup(song.url)
+        if framed and path is not None:
+            cls.frame_store.add(song.url, level, path)
+
+        if path is None and not stored:
+            if cls.needs_refresh(song.track):
+                song.track = await cls.refresh(song.track)
+            cls.audio_cache.record_play(song.track)
+
+        if song.track.loudness is None:
+            # Played without a track gain this time, the DSP stage or FFmpeg's
+            # loudnorm in passthrough mode fall back to a running estimate.
+            cls.analyzer.analyze(song.track, path or song.track.url)
+
+        return cls(song,
+                   track=song.track,
+                   volume=volume,
+                   passthrough=passthrough,
+                   eq=eq,
+                   path=path,
+                   start=start)
+
+    @classmethod
+    async def lookup(cls, search: str) -> Track:
+        """Returns the info of the first match of ``search``."""
+        info = cls.cache.get(search)
+        if info is None:
+            info = await cls.extract_info(search)
+
+        return info
+
+    @classmethod
+    async def playlist(cls, url: str, start: int,
+                       end: int) -> typing.List[Track]:
+        """Returns the info of entries ``start`` to ``end`` of a playlist.
+
+        Entries are only listed, not resolved, see ``refresh``.
+        """
+        try:
+            entries = await cls.engine.playlist(url, start, end)
+        except ExtractionError as e:
+            raise YTDLError(str(e))
+
+        if entries is None:
+            raise YTDLError('Couldn\'t fetch `{}`'.format(url))
+
+        return [
+            cls.cache.put(url, entry)
+            if 'url' in entry else Track.from_info(entry) for entry in entries
+        ]
+
+    @classmethod
+    def needs_refresh(cls, track: Track, position: float = 0.0) -> bool:
+        if track.url is None:
+            return True
+
+        expires = stream_expiry(track.url)
+        if expires is None:
+            return False
+
+        # The stream has to stay valid until the song has finished playing
+        # from ``position`` on.
+        remaining = max(0.0, (track.duration or 0) - position)
+        return expires - time.time() < remaining + cls.REFRESH_MARGIN
+
+    @classmethod
+    async def refresh(cls, track: Track, *, force: bool = False) -> Track:
+        """Returns ``track`` with a stream URL that's valid for its whole
+        duration. With ``force``, the URL of ``track`` is replaced even if it
+        still is.
+        """
+        webpage_url = track.webpage_url
+
+        info = cls.cache.get(webpage_url, count=False)
+        if (info is None or cls.needs_refresh(info)
+                or (force and info.url == track.url)):
+            info = await cls.flights.do(
+                ('url', normalize_query(webpage_url)),
+                functools.partial(cls._process_url, webpage_url))
+
+        if info.loudness is None and track.loudness is not None:
+            # Extracted info doesn't have the measured loudness.
+            info = info.replace(loudness=track.loudness, peak=track.peak)
+        return info
+
+    @classmethod
+    async def extract_info(cls, search: str) -> Track:
+        # Guilds asking for the same thing at the same time share one job.
+        return await cls.flights.do(
+            ('query', normalize_query(search)),
+            functools.partial(cls._extract_info, search))
 
-        partial = functools.partial(cls.ytdl.extract_info,
-                                    search,
-                                    download=False,
-                                    process=False)
-        data = await loop.run_in_executor(None, partial)
+    @classmethod
+    async def _extract_info(cls, search: str) -> Track:
+        info = await cls.store.get(search)
+        if info is not None:
+            # Another query may have cached the video with a stream URL,
+            # which the stored info doesn't replace.
+            cached = cls.cache.get(info.webpage_url, count=False)
+            if cached is not None and cached.url is not None:
+                cls.cache.alias(search, cached.webpage_url)
+                if cached.loudness is None and info.loudness is not None:
+                    cached = cached.replace(loudness=info.loudness,
+                                            peak=info.peak)
+                return cached
+
+            # The stream URL is resolved once the song is about to play.
+            return cls.cache.put(search, info)
+
+        try:
+            webpage_url = await cls.engine.probe(search)
+        except ExtractionError as e:
+            raise YTDLError(str(e))
 
-        if data is None:
+        if webpage_url is None:
             raise YTDLError(
                 'Couldn\'t find anything that matches `{}`'.format(search))
 
-        if 'entries' not in data:
-            process_info = data
-        else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
+        # Another query may already have resolved to the same video.
+        info = cls.cache.get(webpage_url, count=False)
+        if info is None:
+            info = await cls.flights.do(
+                ('url', normalize_query(webpage_url)),
+                functools.partial(cls._process_url, webpage_url))
 
-            if process_info is None:
-                raise YTDLError(
-                    'Couldn\'t find anything that matches `{}`'.format(search))
+        cls.cache.alias(search, info.webpage_url)
+        cls.store.put(search, info)
+        return info
 
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info,
-                                    webpage_url,
-                                    download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+    @classmethod
+    async def _process_url(cls, webpage_url: str) -> Track:
+        try:
+            info = await cls.engine.process(webpage_url)
+        except ExtractionError as e:
+            raise YTDLError(str(e))
 
-        if processed_info is None:
+        if info is None:
             raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
 
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError(
-                        'Couldn\'t retrieve any matches for `{}`'.format(
-                            webpage_url))
-
-        return cls(ctx,
-                   discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS),
-                   data=info)
+        track = cls.cache.put(webpage_url, info)
+        cls.store.put(webpage_url, track)
+        return track
 
     @staticmethod
     def parse_duration(duration: int):
@@ -154,40 +588,476 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
         return ', '.join(duration)
 
+    @staticmethod
+    def parse_timestamp(timestamp: str) -> float:
+        """Seconds in a timestamp like ``83``, ``1:23``, ``1:01:23`` or
+        ``1m23s``. Raises ValueError if it isn't one.
+        """
+        match = (_CLOCK.fullmatch(timestamp.strip())
+                 or _UNITS.fullmatch(timestamp.strip().lower()))
+        if match is None or not any(match.groups()):
+            raise ValueError('Not a timestamp: {}'.format(timestamp))
 
-class Song:
-    __slots__ = ('source', 'requester')
+        hours, minutes, seconds = (float(group or 0)
+                                   for group in match.groups())
+        return hours * 3600 + minutes * 60 + seconds
 
-    def __init__(self, source: YTDLSource):
+    @staticmethod
+    def format_timestamp(seconds: float) -> str:
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+        return '{}:{:02d}'.format(minutes, seconds)
+
+
+def _cleanup_later(source: discord.AudioSource) -> None:
+    # Killing FFmpeg waits for it, which neither the player nor the event
+    # loop can afford.
+    threading.Thread(target=source.cleanup, name='audio-cleanup',
+                     daemon=True).start()
+
+
+class _Restart:
+    """The new process of a YTDLSource restart, until it takes over."""
+    __slots__ = ('source', 'buffer', 'position', 'aligned', 'started',
+                 'ready_at')
+
+    def __init__(self, source: discord.AudioSource,
+                 buffer: discord.AudioSource, position: float, aligned: bool,
+                 started: float):
         self.source = source
-        self.requester = source.requester
+        self.buffer = buffer
+        self.position = position
+        self.aligned = aligned
+        # Before FFmpeg was started, which takes part of the latency.
+        self.started = started
+        self.ready_at: typing.Optional[float] = None
+
+
+class Broadcast:
+    """One stream played in any number of guilds.
+
+    A single FFmpeg process encodes the stream to Opus, and a thread reads
+    it at playback speed and hands each frame to every attached listener.
+    The CPU cost is per stream, not per guild. Listeners join at the live
+    position, and the broadcast stops once the last one detaches.
+
+    The stream URL is resolved again ``REFRESH_AHEAD`` seconds before it
+    expires, and a new FFmpeg process takes over once it has frames.
+    """
+    REFRESH_AHEAD = 5 * 60
+
+    broadcasts: typing.Dict[str, Broadcast] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, key: str, track: Track):
+        self.key = key
+        self.track = track
+        self.frames = 0
+        self.closed = False
+        self.refreshes = 0
+
+        self._listeners: typing.Set[BroadcastListener] = set()
+        self._lock = threading.Lock()
+        self._source = self._open(track.url)
+        # The source of a refreshed URL, until it takes over.
+        self._next: typing.Optional[BufferedAudioSource] = None
+        self._refresher: typing.Optional[asyncio.Task] = None
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+
+        # Started by the first listener, so that it hears the first frame.
+        self._thread = threading.Thread(target=self._run,
+                                        name='broadcast',
+                                        daemon=True)
+
+    @staticmethod
+    def _open(url: str) -> BufferedAudioSource:
+        # The volume is left alone, it's the same stream for every guild.
+        return BufferedAudioSource(
+            discord.FFmpegOpusAudio(
+                url,
+                bitrate=YTDLSource.BITRATE,
+                before_options=YTDLSource.FFMPEG_OPTIONS['before_options'],
+                options=YTDLSource.FFMPEG_OPTIONS['options']))
+
+    @classmethod
+    async def listen(cls, track: Track) -> BroadcastListener:
+        """Attaches a new listener to the broadcast of ``track``, starting
+        one if nobody is listening to it yet.
+        """
+        key = normalize_query(track.webpage_url)
+        with cls._registry_lock:
+            broadcast = cls.broadcasts.get(key)
+            if broadcast is not None:
+                listener = broadcast.attach()
+                if listener is not None:
+                    return listener
+
+        if YTDLSource.needs_refresh(track):
+            track = await YTDLSource.refresh(track)
+
+        # Spawning FFmpeg blocks, it's kept off the event loop and out of
+        # the lock.
+        loop = asyncio.get_running_loop()
+        created = await loop.run_in_executor(None, cls, key, track)
+
+        with cls._registry_lock:
+            broadcast = cls.broadcasts.get(key)
+            listener = broadcast and broadcast.attach()
+            if listener is None:
+                broadcast = cls.broadcasts[key] = created
+                listener = broadcast.attach()
+                created = None
+
+        if created is not None:
+            # Someone else started the same stream in the meantime.
+            created.close()
+        else:
+            broadcast._loop = loop
+            broadcast._refresher = loop.create_task(broadcast._keep_fresh())
+        return listener
+
+    @classmethod
+    def stats(cls) -> typing.Dict[str, int]:
+        broadcasts = list(cls.broadcasts.values())
+        return {
+            'streams': len(broadcasts),
+            'listeners': sum(len(b._listeners) for b in broadcasts),
+            'refreshes': sum(b.refreshes for b in broadcasts),
+        }
+
+    def attach(self) -> typing.Optional[BroadcastListener]:
+        with self._lock:
+            if self.closed:
+                return None
+            listener = BroadcastListener(self)
+            self._listeners.add(listener)
+            if not self._thread.is_alive() and not self.frames:
+                self._thread.start()
+            return listener
+
+    def detach(self, listener: BroadcastListener) -> None:
+        with self._lock:
+            self._listeners.discard(listener)
+        self.close(unused=True)
+
+    def close(self, *, unused: bool = False) -> None:
+        """Stops the broadcast. With ``unused``, only if nobody listens to
+        it anymore.
+        """
+        # Listeners attach holding the registry lock, so the check can't
+        # miss one attaching to a broadcast about to be closed.
+        with self._registry_lock:
+            with self._lock:
+                if self.closed or (unused and self._listeners):
+                    return
+                self.closed = True
+                listeners, self._listeners = self._listeners, set()
+                pending, self._next = self._next, None
+
+            if self.broadcasts.get(self.key) is self:
+                del self.broadcasts[self.key]
+
+        if self._refresher is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._refresher.cancel)
+            except RuntimeError:
+                # The loop is closed, and the task with it.
+                pass
+        for listener in listeners:
+            listener.finish()
+        if pending is not None:
+            pending.cleanup()
+        self._source.cleanup()
+
+    async def _keep_fresh(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            expires = stream_expiry(self.track.url)
+            if expires is None:
+                return
+
+            await asyncio.sleep(
+                max(0.0, expires - time.time() - self.REFRESH_AHEAD))
+            try:
+                track = await YTDLSource.refresh(self.track, force=True)
+            except YTDLError:
+                track = None
+
+            refreshed = track and stream_expiry(track.url)
+            if not refreshed or refreshed <= expires:
+                # Tried again in a minute, until the URL is gone.
+                await asyncio.sleep(60)
+                continue
+
+            source = await loop.run_in_executor(None, self._open, track.url)
+            with self._lock:
+                if not self.closed:
+                    replaced, self._next = self._next, source
+                    self.track = track
+                    self.refreshes += 1
+                    source = replaced
+            if source is not None:
+                source.cleanup()
+
+    def _run(self) -> None:
+        start = time.perf_counter()
+        sent = 0
+        while not self.closed:
+            data = self._source.read()
+            pending = self._next
+            if pending is not None and (not data or pending.ready()):
+                # A refreshed URL takes over once it has frames, or right
+                # away if the old one has ended.
+                with self._lock:
+                    # Unless close() got to it first.
+                    old = None
+                    if self._next is pending:
+                        old, self._source, self._next = (self._source,
+                                                         pending, None)
+                if old is not None:
+                    old.cleanup()
+                    if not data:
+                        continue
+
+            if not data:
+                break
+
+            with self._lock:
+                listeners = list(self._listeners)
+            for listener in listeners:
+                listener.push(data)
+            self.frames += 1
+
+            # Paced like a voice client, so listeners get frames in real time.
+            sent += 1
+            delay = start + sent * FRAME_LENGTH - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1.0:
+                # Behind after a stall, catching up would burst frames.
+                start = time.perf_counter()
+                sent = 0
+
+        self.close()
+
+
+class BroadcastListener(discord.AudioSource):
+    """The frames of a Broadcast as seen by one guild."""
+    # Frames kept for a listener that reads slower than the broadcast, the
+    # oldest are dropped beyond that.
+    MAX_FRAMES = 50
+    # An Opus frame of silence, played when the broadcast is late.
+    SILENCE = b'\xf8\xff\xfe'
+
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self.track = broadcast.track
+
+        self._frames: typing.Deque[bytes] = collections.deque(
+            maxlen=self.MAX_FRAMES)
+        self._cond = threading.Condition()
+        self._done = False
+        self._read = 0
+        self._underruns = 0
+        self._dropped = 0
+
+    @property
+    def position(self) -> float:
+        """Seconds this guild has been listening for."""
+        return self._read * FRAME_LENGTH
+
+    @property
+    def volume(self) -> float:
+        return 1.0
+
+    @volume.setter
+    def volume(self, value: float):
+        # Every guild hears the broadcast as it is.
+        pass
+
+    @property
+    def eq(self) -> str:
+        return 'flat'
+
+    @eq.setter
+    def eq(self, preset: str):
+        pass
+
+    @property
+    def dsp_stats(self) -> typing.Dict[str, typing.Any]:
+        return {}
+
+    async def configure(self, *, volume: float, eq: str) -> None:
+        pass
+
+    @property
+    def buffer_stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'fill': len(self._frames),
+            'target': self.MAX_FRAMES,
+            'underruns': self._underruns,
+            'dropped': self._dropped,
+        }
+
+    def push(self, data: bytes) -> None:
+        with self._cond:
+            if len(self._frames) == self.MAX_FRAMES:
+                self._dropped += 1
+            self._frames.append(data)
+            self._cond.notify()
+
+    def finish(self) -> None:
+        with self._cond:
+            self._done = True
+            self._cond.notify()
+
+    def read(self) -> bytes:
+        with self._cond:
+            # The first frame can take a while, FFmpeg may just be starting.
+            timeout = FRAME_LENGTH * 2 if self._read else 10.0
+            if not self._frames and not self._done:
+                self._cond.wait(timeout)
+
+            if self._frames:
+                self._read += 1
+                return self._frames.popleft()
+
+            if self._done:
+                return b''
+
+            self._underruns += 1
+            return self.SILENCE
+
+    def ready(self) -> bool:
+        return bool(self._frames) or self._done
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self.broadcast.detach(self)
+
+
+class Song:
+    __slots__ = ('track', 'requester', 'channel', 'source')
+
+    def __init__(self, ctx: Context, track: Track):
+        # Only the track info is kept while queued, the stream is opened
+        # by VoiceState right before the song is played.
+        self.track = track
+        self.requester = ctx.author
+        self.channel = ctx.channel
+        self.source = None
+
+    @classmethod
+    def restore(cls, track: Track, requester: discord.abc.User,
+                channel: discord.abc.Messageable) -> Song:
+        """Recreates a song saved by ``snapshot``."""
+        song = cls.__new__(cls)
+        song.track = track
+        song.requester = requester
+        song.channel = channel
+        song.source = None
+        return song
+
+    def snapshot(self) -> dict:
+        return {
+            'data': self.track.to_dict(),
+            'requester': self.requester.id,
+            'channel': self.channel.id,
+        }
+
+    def __str__(self):
+        return '**{0.title}** by **{0.uploader}**'.format(self)
+
+    @property
+    def title(self):
+        return self.track.title
+
+    @property
+    def uploader(self):
+        return self.track.uploader
+
+    @property
+    def uploader_url(self):
+        return self.track.uploader_url
+
+    @property
+    def thumbnail(self):
+        return self.track.thumbnail
+
+    @property
+    def url(self):
+        return self.track.webpage_url
+
+    @property
+    def duration(self):
+        if not self.track.duration:
+            return 'Live'
+        return YTDLSource.parse_duration(self.track.duration)
 
     def create_embed(self):
         embed = (discord.Embed(
             title='Now playing',
-            description='```css\n{0.source.title}\n```'.format(self),
+            description='```css\n{0.title}\n```'.format(self),
             color=discord.Color.blurple()).add_field(
-                name='Duration', value=self.source.duration).add_field(
+                name='Duration', value=self.duration).add_field(
                     name='Requested by',
                     value=self.requester.mention).add_field(
                         name='Uploader',
-                        value='[{0.source.uploader}]({0.source.uploader_url})'.
-                        format(self)).add_field(
-                            name='URL',
-                            value='[Click]({0.source.url})'.format(self)).
-                 set_thumbnail(url=self.source.thumbnail))
+                        value='[{0.uploader}]({0.uploader_url})'.format(
+                            self)).add_field(
+                                name='URL',
+                                value='[Click]({0.url})'.format(self)).
+                 set_thumbnail(url=self.thumbnail))
 
         return embed
 
 
+class RadioSong(Song):
+    """A song played from a shared Broadcast instead of its own stream."""
+    __slots__ = ()
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        snapshot['radio'] = True
+        return snapshot
+
+
 class SongQueue(asyncio.Queue):
+    """The queue of a voice state, indexed so that inserting, moving and
+    removing songs anywhere in it stays fast on long queues.
+
+    ``version`` changes on every change to the queue. ``pops`` and
+    ``pushes`` count the songs taken from the front and put at the end,
+    ``rewrites`` every other change: until the next rewrite, the song at
+    ``index`` was the ``pops + index``-th since then.
+    """
+    def _init(self, maxsize):
+        self._queue = IndexedList()
+        self.version = 0
+        self.rewrites = 0
+        self.pops = 0
+        self.pushes = 0
+
+    def _put(self, item):
+        self._queue.append(item)
+        self.version += 1
+        self.pushes += 1
+
+    def _get(self):
+        self.version += 1
+        self.pops += 1
+        return self._queue.popleft()
+
+    @property
+    def mark(self) -> typing.Tuple[int, int, int]:
+        return self.rewrites, self.pops, self.pushes
+
     def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(
-                itertools.islice(self._queue, item.start, item.stop,
-                                 item.step))
-        else:
-            return self._queue[item]
+        return self._queue[item]
 
     def __iter__(self):
         return self._queue.__iter__()
@@ -197,32 +1067,162 @@ class SongQueue(asyncio.Queue):
 
     def clear(self):
         self._queue.clear()
+        self.version += 1
+        self.rewrites += 1
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        self._queue.shuffle()
+        self.version += 1
+        self.rewrites += 1
+
+    def insert(self, index: int, item):
+        """Puts ``item`` at ``index`` instead of the end of the queue."""
+        self._queue.insert(index, item)
+        self.version += 1
+        self.rewrites += 1
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+
+    def move(self, source: int, destination: int):
+        self._queue.move(source, destination)
+        self.version += 1
+        self.rewrites += 1
 
     def remove(self, index: int):
         del self._queue[index]
+        self.version += 1
+        self.rewrites += 1
+
+    def remove_range(self, start: int, stop: int):
+        self._queue.delete_range(start, stop)
+        self.version += 1
+        self.rewrites += 1
+
+
+class QueuePageSource(menus.PageSource):
+    """The pages of a live song queue.
+
+    Nothing is copied from the queue, a page is read from it when it's
+    shown. Rendered pages are kept until the queue changes.
+    """
+    def __init__(self, songs: SongQueue, *, per_page: int = 10):
+        self.songs = songs
+        self.per_page = per_page
+        self._version = songs.version
+        self._pages: typing.Dict[int, discord.Embed] = {}
+
+    def is_paginating(self) -> bool:
+        return len(self.songs) > self.per_page
+
+    def get_max_pages(self) -> int:
+        return max(1, math.ceil(len(self.songs) / self.per_page))
+
+    async def get_page(self, page_number: int) -> int:
+        if not 0 <= page_number < self.get_max_pages():
+            raise IndexError(page_number)
+        return page_number
+
+    def format_page(self, menu: RoboPages, page_number: int) -> discord.Embed:
+        if self.songs.version != self._version:
+            self._version = self.songs.version
+            self._pages.clear()
+
+        embed = self._pages.get(page_number)
+        if embed is None:
+            embed = self._pages[page_number] = self._render(page_number)
+        return embed
+
+    def _render(self, page_number: int) -> discord.Embed:
+        start = page_number * self.per_page
+        lines = [
+            '`{0}.` [**{1.title}**]({1.url})'.format(i + 1, song)
+            for i, song in enumerate(self.songs[start:start + self.per_page],
+                                     start=start)
+        ]
+
+        return discord.Embed(description='**{} tracks:**\n\n{}'.format(
+            len(self.songs), '\n'.join(lines))).set_footer(
+                text='Viewing page {}/{}'.format(page_number + 1,
+                                                 self.get_max_pages()))
 
 
 class VoiceState:
-    def __init__(self, bot: Bot, ctx: Context):
+    # Seconds before the end of a song at which the next one is opened.
+    PREFETCH_SECONDS = 10.0
+    # Song lookups of one guild resolved at once, see Music.enqueue.
+    RESOLVE_CONCURRENCY = 3
+
+    # With MUSIC_SCHEDULER_THREADS set, every guild is played from that many
+    # shared threads instead of a thread per voice client, and its buffers
+    # are filled by MUSIC_FILLER_THREADS (4 by default).
+    audio_scheduler = (AudioScheduler(
+        int(os.environ['MUSIC_SCHEDULER_THREADS']),
+        fill_threads=int(os.environ.get('MUSIC_FILLER_THREADS', 4)))
+                       if os.environ.get('MUSIC_SCHEDULER_THREADS') else None)
+
+    def __init__(self, bot: Bot, guild: discord.Guild):
         self.bot = bot
-        self._ctx = ctx
+        self.guild_id = guild.id
+        self.last_activity = time.monotonic()
 
         self.current = None
         self.voice = None
+        # The scheduled stream playing the current song, see play.
+        self._stream = None
         self.next = asyncio.Event()
         self.songs = SongQueue()
 
         self._loop = False
         self._volume = 0.5
+        self._eq = 'flat'
+        self.passthrough = YTDLSource.PASSTHROUGH
+        # Seconds songs fade into each other over, 0 when they don't.
+        self.crossfade = 0.0
         self.skip_votes = set()
 
+        self.ingestion = None
+        # Looked up songs are queued in the order they were asked for.
+        self.resolver = OrderedPipeline(self.RESOLVE_CONCURRENCY)
+        self.prefetch_seconds = self.PREFETCH_SECONDS
+        self._prefetcher = None
+        self._prefetched = None
+        self._ended_at = None
+        self.transition_gaps = collections.deque(maxlen=50)
+
+        # The song restored from a snapshot and the position to resume it at.
+        self._resume = None
+        # SongQueue.mark of the last queue saved, see snapshot.
+        self._saved_queue = None
+
         self.audio_player = bot.loop.create_task(self.audio_player_task())
 
-    def __del__(self):
+    def close(self) -> None:
+        """Cancels every task of this voice state."""
         self.audio_player.cancel()
+        self.cancel_ingestion()
+        self._discard_prefetched()
+
+    @property
+    def tasks(self) -> typing.List[asyncio.Task]:
+        tasks = (self.audio_player, self.ingestion, self._prefetcher)
+        return [task for task in tasks if task is not None and not task.done()]
+
+    @property
+    def is_idle(self) -> bool:
+        if self.ingestion is not None and not self.ingestion.done():
+            return False
+        # is_connected() is also False while discord.py reconnects the
+        # voice websocket, a voice client that's gone is no longer the
+        # guild's.
+        if not self.voice or self.voice.guild.voice_client is not self.voice:
+            return True
+        # A paused song is still in use, whoever paused it may come back.
+        return not self.is_streaming() and not (self.current is not None
+                                                and self.is_paused())
+
+    def touch(self) -> None:
+        self.last_activity = time.monotonic()
 
     @property
     def loop(self):
@@ -236,51 +1236,322 @@ class VoiceState:
     def volume(self):
         return self._volume
 
-    @volume.setter
-    def volume(self, value: float):
+    async def set_volume(self, value: float) -> None:
+        if self.current and self.current.source:
+            await self.current.source.configure(volume=value, eq=self._eq)
         self._volume = value
 
+    @property
+    def eq(self) -> str:
+        return self._eq
+
+    async def set_eq(self, preset: str) -> None:
+        if self.current and self.current.source:
+            await self.current.source.configure(volume=self._volume,
+                                                eq=preset)
+        self._eq = preset
+
     @property
     def is_playing(self):
         return self.voice and self.current
 
+    @property
+    def position(self) -> float:
+        """Seconds of the current song that have been played so far."""
+        if self.current is None:
+            return 0.0
+        if self.current.source is not None:
+            return self.current.source.position
+        if self._resume is not None and self._resume[0] is self.current:
+            return self._resume[1]
+        return 0.0
+
+    def snapshot(self) -> typing.Optional[tuple]:
+        """Returns this player as a SessionStore snapshot, ``None`` when
+        there is nothing to resume. The queue only has the changes since the
+        last snapshot that was saved, or nothing when there are none.
+        """
+        if not self.voice or not self.voice.channel or (not self.current
+                                                        and not self.songs):
+            self._saved_queue = None
+            return None
+
+        state = {
+            'voice_channel': self.voice.channel.id,
+            'volume': self._volume,
+            'eq': self._eq,
+            'loop': self._loop,
+            'passthrough': self.passthrough,
+            'crossfade': self.crossfade,
+            'current': self.current and self.current.snapshot(),
+        }
+
+        return (self.guild_id, state, round(self.position, 3),
+                self._queue_update())
+
+    def _queue_update(self) -> typing.Optional[QueueUpdate]:
+        songs = self.songs
+        if self._saved_queue is None or self._saved_queue[0] != songs.rewrites:
+            return QueueUpdate(songs.pops, [
+                (songs.pops + index, song.snapshot())
+                for index, song in enumerate(songs)
+            ], True)
+
+        _, pops, pushes = self._saved_queue
+        if (pops, pushes) == (songs.pops, songs.pushes):
+            return None
+
+        # Only what was queued since is written, songs that started since
+        # are dropped by their position.
+        start = len(songs) - min(songs.pushes - pushes, len(songs))
+        return QueueUpdate(songs.pops, [
+            (songs.pops + index, songs[index].snapshot())
+            for index in range(start, len(songs))
+        ], False)
+
+    def saved(self, mark: typing.Tuple[int, int, int]) -> None:
+        """Called once the snapshot taken at SongQueue.mark ``mark`` has
+        been stored, later ones only store what changed since.
+        """
+        self._saved_queue = mark
+
+    @property
+    def priority(self) -> float:
+        """The scheduling weight of this guild's song lookups."""
+        if not self.current and not self.songs:
+            # Nothing to listen to yet, the first song matters most.
+            return 4.0
+        return 1.0 / (1 + len(self.songs) // 10)
+
     async def audio_player_task(self):
         while True:
             self.next.clear()
 
-            if not self.loop:
-                # Try to get the next song within 3 minutes.
-                # If no song will be added to the queue in time,
-                # the player will disconnect due to performance
-                # reasons.
-                try:
-                    # async with timeout(180):  # 3 minutes
-                    self.current = await self.songs.get()
-                except asyncio.TimeoutError:
-                    self.bot.loop.create_task(self.stop())
-                    return
+            if not self.loop or self.current is None:
+                # Waits for as long as it takes, idle players are
+                # disconnected by Music.reaper.
+                self.current = None
+                self.current = await self.songs.get()
 
-            self.current.source.volume = self._volume
-            self.voice.play(self.current.source, after=self.play_next_song)
-            await self.current.source.channel.send(
-                embed=self.current.create_embed())
+            try:
+                self.current.source = await self._open_source(self.current)
+            except (YTDLError, discord.ClientException) as e:
+                # ClientException: FFmpeg couldn't be started.
+                await self.current.channel.send(
+                    'An error occurred while processing this request: {}'.
+                    format(str(e)))
+                self.current = None
+                self._loop = False
+                continue
+            finally:
+                self._resume = None
+
+            source = self.current.source
+            if self.crossfade and dsp.AVAILABLE and not source.is_opus():
+                source = CrossfadeSource(source, self.crossfade,
+                                         self._upcoming)
+            self.play(source, after=self.play_next_song)
+            if self._ended_at is not None:
+                self.transition_gaps.append(time.perf_counter() -
+                                            self._ended_at)
+                self._ended_at = None
+
+            self._schedule_prefetch()
+            self.touch()
+            await self.current.channel.send(embed=self.current.create_embed())
 
             await self.next.wait()
+            self.touch()
+            # The finished FFmpeg source can't be replayed, looping opens
+            # a new one.
+            self.current.source = None
+
+    async def _open_source(self, song: Song) -> YTDLSource:
+        # An unfinished prefetch is dropped, the extraction it started is
+        # shared through YTDLSource.flights so nothing is lost.
+        if self._prefetcher is not None:
+            self._prefetcher.cancel()
+            self._prefetcher = None
+
+        start = 0.0
+        if self._resume is not None and self._resume[0] is song:
+            start = self._resume[1]
+
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is not None:
+            prefetched_song, source = prefetched
+            if prefetched_song is song:
+                try:
+                    await source.configure(volume=self._volume, eq=self._eq)
+                except YTDLError:
+                    # Played as it was opened rather than not at all.
+                    pass
+                return source
+
+            # The queue changed (skip, loop, remove...) since it was opened.
+            source.cleanup()
+
+        if isinstance(song, RadioSong):
+            # Joins at the live position, there's no position to resume.
+            return await Broadcast.listen(song.track)
+
+        return await YTDLSource.create_source(song,
+                                              volume=self._volume,
+                                              passthrough=self.opus_passthrough,
+                                              eq=self._eq,
+                                              start=start)
+
+    def _schedule_prefetch(self) -> None:
+        duration = self.current.track.duration
+        if not duration:
+            return
+
+        # Opened before the crossfade begins, which mixes it in.
+        delay = max(
+            0.0,
+            duration - self.position - self.prefetch_seconds - self.crossfade)
+        self._prefetcher = self.bot.loop.create_task(self._prefetch(delay))
+
+    async def seek(self, position: float) -> None:
+        """Plays the current song from ``position`` seconds on."""
+        await self.current.source.seek(position)
+        # The next song is prefetched by the new end of this one. It's
+        # opened again, a crossfade may have started mixing it in.
+        self._discard_prefetched()
+        self._schedule_prefetch()
+
+    def _upcoming(self) -> typing.Optional[YTDLSource]:
+        # Called from the player thread when the crossfade is due.
+        prefetched = self._prefetched
+        return prefetched and prefetched[1]
+
+    async def _prefetch(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+        song = self.current if self.loop else (self.songs[0]
+                                               if self.songs else None)
+        if song is None or isinstance(song, RadioSong):
+            return
+
+        try:
+            source = await YTDLSource.create_source(
+                song,
+                volume=self._volume,
+                passthrough=self.opus_passthrough,
+                eq=self._eq)
+        except YTDLError:
+            # Reported once the song is actually up.
+            return
+
+        if not self.loop and not (self.songs and self.songs[0] is song):
+            # The queue changed while it was opened.
+            source.cleanup()
+            return
+
+        if self._prefetched is not None:
+            self._prefetched[1].cleanup()
+        self._prefetched = (song, source)
+
+    @property
+    def opus_passthrough(self) -> bool:
+        """Whether songs are opened in passthrough mode, crossfades need
+        PCM frames to mix.
+        """
+        return self.passthrough and not self.crossfade
+
+    def clear_queue(self) -> None:
+        """Empties the queue along with the song opened ahead of it."""
+        self.songs.clear()
+        self._discard_prefetched()
+
+    def queue_changed(self) -> None:
+        """Drops the prefetched song once the queue no longer plays it next,
+        the song that does is prefetched instead.
+        """
+        prefetched = self._prefetched
+        if prefetched is None or self.loop:
+            return
+        if self.songs and self.songs[0] is prefetched[0]:
+            return
+
+        self._discard_prefetched()
+        if self.current is not None:
+            self._schedule_prefetch()
+
+    def _discard_prefetched(self) -> None:
+        if self._prefetcher is not None:
+            self._prefetcher.cancel()
+            self._prefetcher = None
+
+        if self._prefetched is not None:
+            self._prefetched[1].cleanup()
+            self._prefetched = None
 
     def play_next_song(self, error=None):
+        # Called from the voice client's player thread.
+        self._ended_at = time.perf_counter()
+        self.bot.loop.call_soon_threadsafe(self.next.set)
+
         if error:
             raise VoiceError(str(error))
 
-        self.next.set()
+    def play(self, source: discord.AudioSource, *, after=None) -> None:
+        if self.audio_scheduler is None:
+            self.voice.play(source, after=after)
+        else:
+            self._stream = self.audio_scheduler.play(self.voice,
+                                                     source,
+                                                     after=after)
+
+    def pause(self) -> None:
+        if self._stream is not None:
+            self._stream.pause()
+        elif self.voice:
+            self.voice.pause()
+
+    def resume(self) -> None:
+        if self._stream is not None:
+            self._stream.resume()
+        elif self.voice:
+            self.voice.resume()
+
+    def stop_playing(self) -> None:
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream = None
+        elif self.voice:
+            self.voice.stop()
+
+    def is_streaming(self) -> bool:
+        """Whether audio is being sent, as opposed to paused or stopped."""
+        if self._stream is not None:
+            return self._stream.is_playing()
+        return bool(self.voice) and self.voice.is_playing()
+
+    def is_paused(self) -> bool:
+        if self._stream is not None:
+            return self._stream.is_paused()
+        return bool(self.voice) and self.voice.is_paused()
+
+    @property
+    def stream_stats(self) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        return self._stream and self._stream.stats
 
     def skip(self):
         self.skip_votes.clear()
 
         if self.is_playing:
-            self.voice.stop()
+            self.stop_playing()
+
+    def cancel_ingestion(self) -> None:
+        if self.ingestion is not None:
+            self.ingestion.cancel()
+            self.ingestion = None
 
     async def stop(self):
-        self.songs.clear()
+        self.cancel_ingestion()
+        self.clear_queue()
+        self.stop_playing()
 
         if self.voice:
             await self.voice.disconnect()
@@ -288,9 +1559,48 @@ class VoiceState:
 
 
 class Music(Cog):
+    # Playlists are read in pages, the first one small so that playback
+    # can start right away.
+    PLAYLIST_FIRST_PAGE = 10
+    PLAYLIST_PAGE = 100
+    # Most songs queued from a single playlist command.
+    PLAYLIST_LIMIT = 500
+    # Playlist songs resolved in the background at once, per guild.
+    PLAYLIST_CONCURRENCY = 2
+    # A page the scheduler turns away is asked for again after a delay
+    # that doubles up to PLAYLIST_MAX_BACKOFF seconds, at most
+    # PLAYLIST_RETRIES times in a row.
+    PLAYLIST_BACKOFF = 1.0
+    PLAYLIST_MAX_BACKOFF = 30.0
+    PLAYLIST_RETRIES = 8
+    # Seconds without playback after which the bot leaves, unless the
+    # channel is a 24/7 one.
+    IDLE_TIMEOUT = 180
+    # Most songs a single play command takes, one per line.
+    QUERY_LIMIT = 25
+    # Distinct errors listed in the reply to a play command, the same error
+    # for several songs is listed once.
+    ERROR_LINES = 5
+    # Longest crossfade between songs, in seconds.
+    MAX_CROSSFADE = 12
+    # Players are saved this often, and resumed after a restart unless
+    # their snapshot is older than SESSION_MAX_AGE seconds.
+    SNAPSHOT_INTERVAL = 15
+    SESSION_MAX_AGE = 24 * 3600
+
     def __init__(self, bot: Bot):
         self.bot = bot
         self.voice_states = {}
+        self.scheduler = FairScheduler()
+        self.reaped = 0
+        self.reaper.start()
+
+        self.sessions = SessionStore('utils/sessions.db')
+        # (state, position) of the last saved snapshot of each guild.
+        self._saved = {}
+        self.restored = 0
+        self.snapshotter.start()
+        self.bot.loop.create_task(self.restore_sessions())
 
     @property
     def display_emoji(self) -> discord.PartialEmoji:
@@ -299,14 +1609,30 @@ class Music(Cog):
     def get_voice_state(self, ctx: Context):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            state = VoiceState(self.bot, ctx.guild)
             self.voice_states[ctx.guild.id] = state
 
         return state
 
     def cog_unload(self):
-        for state in self.voice_states.values():
-            self.bot.loop.create_task(state.stop())
+        self.reaper.cancel()
+        self.snapshotter.cancel()
+        # Taken before the players are stopped, so that they are resumed
+        # once the cog is loaded again. The next cog waits for both before
+        # it restores them.
+        states = list(self.voice_states.values())
+        self.bot._music_unloading = self.bot.loop.create_task(
+            self.unload_sessions(*self.collect_sessions(), states))
+        for state in states:
+            state.close()
+
+        YTDLSource.engine.shutdown()
+        YTDLSource.audio_cache.close()
+        YTDLSource.frame_store.close()
+        YTDLSource.analyzer.close()
+        if VoiceState.audio_scheduler is not None:
+            VoiceState.audio_scheduler.close()
+        self.bot.loop.create_task(YTDLSource.store.close())
 
     def cog_check(self, ctx: Context):
         if not ctx.guild:
@@ -317,6 +1643,200 @@ class Music(Cog):
 
     async def cog_before_invoke(self, ctx: Context):
         ctx.voice_state = self.get_voice_state(ctx)
+        ctx.voice_state.touch()
+
+    async def drop_voice_state(self, guild_id: int) -> None:
+        state = self.voice_states.pop(guild_id, None)
+        if state is not None:
+            await state.stop()
+            state.close()
+
+        self._saved.pop(guild_id, None)
+        await self.sessions.delete(guild_id)
+
+    def collect_sessions(self) -> typing.Tuple[list, list]:
+        """Returns the snapshots that changed since they were last saved,
+        and the guilds whose saved snapshot has nothing left to resume.
+        Snapshots come with the voice state and queue mark they were taken
+        from, nothing counts as saved until save_sessions stored it.
+        """
+        snapshots, finished = [], []
+        for guild_id, state in self.voice_states.items():
+            snapshot = state.snapshot()
+            if snapshot is None:
+                if guild_id in self._saved:
+                    finished.append(guild_id)
+                continue
+
+            _, saved, position, queue = snapshot
+            if queue is None and self._saved.get(guild_id) == (saved,
+                                                               position):
+                continue
+
+            snapshots.append((snapshot, state, state.songs.mark))
+
+        return snapshots, finished
+
+    async def save_sessions(self, snapshots: list, finished: list) -> None:
+        await self.sessions.save([snapshot for snapshot, *_ in snapshots])
+        for (guild_id, saved, position, _), state, mark in snapshots:
+            # Dropped while it was saved, the next player starts over.
+            if self.voice_states.get(guild_id) is state:
+                self._saved[guild_id] = (saved, position)
+                state.saved(mark)
+
+        for guild_id in finished:
+            await self.sessions.delete(guild_id)
+            self._saved.pop(guild_id, None)
+
+    async def close_sessions(self, snapshots: list, finished: list) -> None:
+        await self.save_sessions(snapshots, finished)
+        await self.sessions.close()
+
+    async def unload_sessions(self, snapshots: list, finished: list,
+                              states: typing.List[VoiceState]) -> None:
+        try:
+            await self.close_sessions(snapshots, finished)
+        except Exception:
+            log.exception('Failed to save the sessions')
+
+        for state in states:
+            try:
+                await state.stop()
+            except Exception:
+                log.exception('Failed to stop the voice state of %s',
+                              state.guild_id)
+
+    @tasks.loop(seconds=SNAPSHOT_INTERVAL)
+    async def snapshotter(self):
+        try:
+            await self.save_sessions(*self.collect_sessions())
+        except Exception:
+            # Nothing counts as saved, the next run writes it again.
+            log.exception('Failed to save the sessions')
+
+    @snapshotter.before_loop
+    async def before_snapshotter(self):
+        await self.bot.wait_until_ready()
+
+    async def restore_sessions(self):
+        await self.bot.wait_until_ready()
+
+        unloading = getattr(self.bot, '_music_unloading', None)
+        if unloading is not None:
+            # The cog this one replaces is still saving and disconnecting.
+            await asyncio.wait([unloading])
+
+        for snapshot in await self.sessions.load(self.SESSION_MAX_AGE):
+            try:
+                restored = await self.restore_session(snapshot)
+            except (discord.DiscordException, asyncio.TimeoutError):
+                # Couldn't connect this time, the snapshot is kept for the
+                # next start until it's too old.
+                log.warning('Failed to reconnect the session of %s',
+                            snapshot['guild_id'],
+                            exc_info=True)
+                continue
+            except Exception:
+                log.exception('Failed to restore the session of %s',
+                              snapshot['guild_id'])
+                restored = False
+
+            if restored:
+                self.restored += 1
+            else:
+                await self.sessions.delete(snapshot['guild_id'])
+
+    async def restore_session(self, snapshot: dict) -> bool:
+        """Reconnects to the voice channel of a snapshot and resumes its
+        songs where they were, without looking them up again.
+        """
+        guild = self.bot.get_guild(snapshot['guild_id'])
+        if guild is None or guild.id in self.voice_states:
+            # Gone, or someone started a new player in the meantime.
+            return False
+
+        saved = snapshot['state']
+        channel = guild.get_channel(saved['voice_channel'])
+        if not isinstance(channel, discord.VoiceChannel):
+            return False
+
+        entries = snapshot['queue']
+        if saved['current'] is not None:
+            entries = [saved['current'], *entries]
+
+        requesters = {}
+        for user_id in {entry['requester'] for entry in entries}:
+            member = guild.get_member(user_id)
+            if member is None:
+                try:
+                    member = await guild.fetch_member(user_id)
+                except discord.HTTPException:
+                    member = guild.me
+            requesters[user_id] = member
+
+        songs = []
+        for entry in entries:
+            text_channel = guild.get_channel(
+                entry['channel']) or guild.system_channel
+            if text_channel is not None:
+                cls = RadioSong if entry.get('radio') else Song
+                songs.append(
+                    cls.restore(Track.from_info(entry['data']),
+                                 requesters[entry['requester']], text_channel))
+        if not songs:
+            return False
+
+        async with self.bot.voice_lock(guild.id):
+            # Connected to the 24/7 channel by on_ready first, the voice
+            # client is taken over.
+            voice = guild.voice_client
+            if voice is None:
+                voice = await channel.connect()
+            elif voice.channel != channel:
+                await voice.move_to(channel)
+
+        if guild.id in self.voice_states:
+            return False
+
+        state = VoiceState(self.bot, guild)
+        state.voice = voice
+        state._volume = saved['volume']
+        # Snapshots taken before equalizers existed don't have one.
+        state._eq = saved.get('eq', 'flat')
+        state.passthrough = saved['passthrough']
+        state.crossfade = saved.get('crossfade', 0.0)
+        state._loop = saved['loop']
+        if saved['current'] is not None:
+            state._resume = (songs[0], snapshot['position'])
+        for song in songs:
+            state.songs.put_nowait(song)
+
+        self.voice_states[guild.id] = state
+        return True
+
+    @tasks.loop(seconds=60)
+    async def reaper(self):
+        now = time.monotonic()
+        for guild_id, state in list(self.voice_states.items()):
+            if not state.is_idle or now - state.last_activity < self.IDLE_TIMEOUT:
+                continue
+
+            channel = state.voice and state.voice.channel
+            if channel and channel.id in self.bot._24_7:
+                continue
+
+            try:
+                await self.drop_voice_state(guild_id)
+            except Exception:
+                log.exception('Failed to drop the idle voice state of %s',
+                              guild_id)
+            else:
+                self.reaped += 1
+
+    @reaper.before_loop
+    async def before_reaper(self):
+        await self.bot.wait_until_ready()
 
     async def cog_command_error(self, ctx: Context,
                                 error: commands.CommandError):
@@ -327,15 +1847,8 @@ class Music(Cog):
     async def _join(self, ctx: Context):
         """Joins a voice channel."""
 
-        destination = ctx.author.voice.channel
-        if ctx.voice_state.voice:
-            try:
-                await ctx.voice_state.voice.move_to(destination)
-                return
-            except Exception:
-                pass
         try:
-            ctx.voice_state.voice = await destination.connect()
+            await self.connect(ctx.voice_state, ctx.author.voice.channel)
         except Exception:
             pass
 
@@ -355,11 +1868,20 @@ class Music(Cog):
             )
 
         destination = channel or ctx.author.voice.channel
-        if ctx.voice_state.voice:
-            await ctx.voice_state.voice.move_to(destination)
-            return
-
-        ctx.voice_state.voice = await destination.connect()
+        await self.connect(ctx.voice_state, destination)
+
+    async def connect(self, state: VoiceState,
+                      destination: discord.VoiceChannel) -> None:
+        """Connects a voice state to ``destination``, or moves it there."""
+        guild = destination.guild
+        async with self.bot.voice_lock(guild.id):
+            if not state.voice:
+                # Already connected to a 24/7 channel, or by a restore.
+                state.voice = guild.voice_client
+            if not state.voice:
+                state.voice = await destination.connect()
+            elif state.voice.channel != destination:
+                await state.voice.move_to(destination)
 
     @commands.command(name='leave', aliases=['disconnect'])
     @commands.has_permissions(manage_guild=True)
@@ -369,8 +1891,7 @@ class Music(Cog):
         if not ctx.voice_state.voice:
             return await ctx.send('Not connected to any voice channel.')
 
-        await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        await self.drop_voice_state(ctx.guild.id)
 
     @commands.command(name='volume')
     async def _volume(self, ctx: Context, *, volume: int):
@@ -379,12 +1900,78 @@ class Music(Cog):
         if not ctx.voice_state.is_playing:
             return await ctx.send('Nothing being played at the moment.')
 
-        if 0 > volume > 100:
+        if not 0 <= volume <= 100:
             return await ctx.send('Volume must be between 0 and 100')
 
-        ctx.voice_state.volume = volume / 100
+        try:
+            await ctx.voice_state.set_volume(volume / 100)
+        except YTDLError as e:
+            return await ctx.send(
+                'An error occurred while processing this request: {}'.format(
+                    str(e)))
         await ctx.send('Volume of the player set to {}%'.format(volume))
 
+    @commands.command(name='eq', aliases=['equalizer'])
+    async def _eq(self, ctx: Context, preset: str = None):
+        """Sets the equalizer preset of the player. Lists the presets if none is given."""
+
+        presets = ', '.join('`{}`'.format(name) for name in EQ_PRESETS)
+        if preset is None:
+            return await ctx.send('Equalizer set to **{}**, presets: {}'.format(
+                ctx.voice_state.eq, presets))
+
+        preset = preset.lower()
+        if preset not in EQ_PRESETS:
+            return await ctx.send(
+                'Unknown preset, try one of {}'.format(presets))
+
+        try:
+            await ctx.voice_state.set_eq(preset)
+        except YTDLError as e:
+            return await ctx.send(
+                'An error occurred while processing this request: {}'.format(
+                    str(e)))
+        await ctx.send('Equalizer set to **{}**'.format(preset))
+
+    @commands.command(name='crossfade', aliases=['fade'])
+    async def _crossfade(self, ctx: Context, seconds: float = None):
+        """Fades songs into each other over that many seconds, 0 turns it off. Shows the setting if no value is given."""
+
+        if seconds is None:
+            if not ctx.voice_state.crossfade:
+                return await ctx.send('Crossfade is off.')
+            return await ctx.send('Crossfade is set to {:g} seconds.'.format(
+                ctx.voice_state.crossfade))
+
+        if not 0 <= seconds <= self.MAX_CROSSFADE:
+            return await ctx.send('Crossfade must be between 0 and {} seconds'.format(
+                self.MAX_CROSSFADE))
+
+        if seconds and not dsp.AVAILABLE:
+            return await ctx.send('Crossfade needs NumPy, which isn\'t installed.')
+
+        ctx.voice_state.crossfade = seconds
+        if not seconds:
+            return await ctx.send('Crossfade turned off.')
+        # The current song may be playing in passthrough mode, which can't
+        # be mixed. Songs are opened in PCM mode from the next one on.
+        await ctx.send('Crossfade set to {:g} seconds, from the next song on.'.format(
+            seconds))
+
+    @commands.command(name='passthrough')
+    @commands.has_permissions(manage_guild=True)
+    async def _passthrough(self, ctx: Context, enabled: bool = None):
+        """Lets FFmpeg encode the songs, or decodes them to apply the volume and the equalizer right away. Shows the setting if no value is given."""
+
+        if enabled is None:
+            return await ctx.send('Passthrough is {}.'.format(
+                'on' if ctx.voice_state.passthrough else 'off'))
+
+        # Like crossfades, the mode is picked when a song is opened.
+        ctx.voice_state.passthrough = enabled
+        await ctx.send('Passthrough turned {}, from the next song on.'.format(
+            'on' if enabled else 'off'))
+
     @commands.command(name='now', aliases=['current', 'playing', 'np'])
     async def _now(self, ctx: Context):
         """Displays the currently playing song."""
@@ -396,9 +1983,8 @@ class Music(Cog):
     async def _pause(self, ctx: Context):
         """Pauses the currently playing song."""
 
-        if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_playing(
-        ):
-            ctx.voice_state.voice.pause()
+        if ctx.voice_state.is_playing and ctx.voice_state.is_streaming():
+            ctx.voice_state.pause()
             await ctx.message.add_reaction('⏯')
 
     @commands.command(name='resume')
@@ -406,20 +1992,78 @@ class Music(Cog):
     async def _resume(self, ctx: Context):
         """Resumes a currently paused song."""
 
-        if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_paused(
-        ):
-            ctx.voice_state.voice.resume()
+        if ctx.voice_state.is_playing and ctx.voice_state.is_paused():
+            ctx.voice_state.resume()
             await ctx.message.add_reaction('⏯')
 
+    async def _seek_to(self, ctx: Context, position: float):
+        state = ctx.voice_state
+        if not state.is_playing or state.current.source is None:
+            return await ctx.send('Nothing being played at the moment.')
+
+        if isinstance(state.current, RadioSong):
+            return await ctx.send('Radio streams can\'t be seeked.')
+
+        duration = state.current.track.duration
+        if duration and position >= duration:
+            return await ctx.send('That\'s past the end of the song ({}).'.format(
+                YTDLSource.format_timestamp(duration)))
+
+        try:
+            await state.seek(max(0.0, position))
+        except YTDLError as e:
+            return await ctx.send(
+                'An error occurred while processing this request: {}'.format(
+                    str(e)))
+        await ctx.send('Playing from **{}**'.format(
+            YTDLSource.format_timestamp(state.position)))
+
+    @commands.command(name='seek')
+    @commands.has_permissions(manage_guild=True)
+    async def _seek(self, ctx: Context, *, timestamp: str):
+        """Plays the current song from a timestamp, like `83`, `1:23` or `1m23s`."""
+
+        try:
+            position = YTDLSource.parse_timestamp(timestamp)
+        except ValueError:
+            return await ctx.send('`{}` isn\'t a timestamp, try `1:23`.'.format(
+                timestamp))
+        await self._seek_to(ctx, position)
+
+    @commands.command(name='forward', aliases=['ff'])
+    @commands.has_permissions(manage_guild=True)
+    async def _forward(self, ctx: Context, *, amount: str = '10'):
+        """Skips ahead in the current song, 10 seconds by default."""
+
+        try:
+            amount = YTDLSource.parse_timestamp(amount)
+        except ValueError:
+            return await ctx.send('`{}` isn\'t a timestamp, try `30`.'.format(
+                amount))
+        await self._seek_to(ctx, ctx.voice_state.position + amount)
+
+    @commands.command(name='rewind', aliases=['rw'])
+    @commands.has_permissions(manage_guild=True)
+    async def _rewind(self, ctx: Context, *, amount: str = '10'):
+        """Goes back in the current song, 10 seconds by default."""
+
+        try:
+            amount = YTDLSource.parse_timestamp(amount)
+        except ValueError:
+            return await ctx.send('`{}` isn\'t a timestamp, try `30`.'.format(
+                amount))
+        await self._seek_to(ctx, ctx.voice_state.position - amount)
+
     @commands.command(name='stop')
     @commands.has_permissions(manage_guild=True)
     async def _stop(self, ctx: Context):
         """Stops playing song and clears the queue."""
 
-        ctx.voice_state.songs.clear()
+        ctx.voice_state.cancel_ingestion()
+        ctx.voice_state.clear_queue()
 
-        if not ctx.voice_state.is_playing:
-            ctx.voice_state.voice.stop()
+        if ctx.voice_state.is_playing:
+            ctx.voice_state.stop_playing()
             await ctx.message.add_reaction('⏹')
 
     @commands.command(name='skip')
@@ -453,28 +2097,15 @@ class Music(Cog):
     @commands.command(name='queue')
     async def _queue(self, ctx: Context, *, page: int = 1):
         """Shows the player's queue.
-        You can optionally specify the page to show. Each page contains 10 elements.
+        You can optionally specify the page to start at. Each page contains 10 elements.
         """
 
         if len(ctx.voice_state.songs) == 0:
             return await ctx.send('Empty queue.')
 
-        items_per_page = 10
-        pages = math.ceil(len(ctx.voice_state.songs) / items_per_page)
-
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
-
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.songs[start:end],
-                                 start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(
-                i + 1, song)
-
-        embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(
-            len(ctx.voice_state.songs), queue)).set_footer(
-                text='Viewing page {}/{}'.format(page, pages)))
-        await ctx.send(embed=embed)
+        source = QueuePageSource(ctx.voice_state.songs)
+        page = min(max(page, 1), source.get_max_pages())
+        await RoboPages(source, ctx=ctx).start(page_number=page - 1)
 
     @commands.command(name='shuffle')
     async def _shuffle(self, ctx: Context):
@@ -484,6 +2115,7 @@ class Music(Cog):
             return await ctx.send('Empty queue.')
 
         ctx.voice_state.songs.shuffle()
+        ctx.voice_state.queue_changed()
         await ctx.message.add_reaction('✅')
 
     @commands.command(name='remove')
@@ -494,6 +2126,39 @@ class Music(Cog):
             return await ctx.send('Empty queue.')
 
         ctx.voice_state.songs.remove(index - 1)
+        ctx.voice_state.queue_changed()
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(name='removerange')
+    async def _removerange(self, ctx: Context, start: int, end: int):
+        """Removes the songs from the queue between two indexes, both included."""
+
+        songs = ctx.voice_state.songs
+        if len(songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        if not 1 <= start <= end <= len(songs):
+            return await ctx.send(
+                'The indexes must be between 1 and {}.'.format(len(songs)))
+
+        songs.remove_range(start - 1, end)
+        ctx.voice_state.queue_changed()
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(name='move')
+    async def _move(self, ctx: Context, source: int, destination: int):
+        """Moves a song of the queue to another index."""
+
+        songs = ctx.voice_state.songs
+        if len(songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        if not (1 <= source <= len(songs) and 1 <= destination <= len(songs)):
+            return await ctx.send(
+                'The indexes must be between 1 and {}.'.format(len(songs)))
+
+        songs.move(source - 1, destination - 1)
+        ctx.voice_state.queue_changed()
         await ctx.message.add_reaction('✅')
 
     @commands.command(name='loop')
@@ -511,6 +2176,23 @@ class Music(Cog):
     @commands.command(name='play')
     async def _play(self, ctx: Context, *, search: str):
         """Plays a song. If there are songs in the queue, this will be queued until the other songs finished playing. This command automatically searches from various sites if no URL is provided. A list of these sites can be found here: https://rg3.github.io/youtube-dl/supportedsites.html
+        Several songs can be queued at once, one per line.
+        """
+
+        await self.enqueue(ctx, search)
+
+    @commands.command(name='playnext')
+    async def _playnext(self, ctx: Context, *, search: str):
+        """Plays a song right after the current one, ahead of the rest of the queue.
+        Several songs can be queued at once, one per line.
+        """
+
+        await self.enqueue(ctx, search, front=True)
+
+    @commands.command(name='radio')
+    async def _radio(self, ctx: Context, *, search: str):
+        """Queues a live stream shared with every other server playing it.
+        The stream joins at its live position and its volume can't be changed.
         """
 
         if not ctx.voice_state.voice:
@@ -518,21 +2200,249 @@ class Music(Cog):
 
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx,
-                                                        search,
-                                                        loop=self.bot.loop)
+                info = await self.scheduler.run(
+                    ctx.guild.id,
+                    functools.partial(YTDLSource.lookup, search),
+                    weight=ctx.voice_state.priority)
+            except AdmissionError as e:
+                await ctx.send(str(e))
             except YTDLError as e:
                 await ctx.send(
                     'An error occurred while processing this request: {}'.
                     format(str(e)))
             else:
-                song = Song(source)
+                song = RadioSong(ctx, info)
 
                 await ctx.voice_state.songs.put(song)
-                await ctx.send('Enqueued {}'.format(str(source)))
+                await ctx.send('Enqueued {} as a radio stream'.format(str(song)))
+
+    async def enqueue(self, ctx: Context, search: str, *, front: bool = False):
+        queries = [line.strip() for line in search.splitlines() if line.strip()]
+        if len(queries) > self.QUERY_LIMIT:
+            return await ctx.send(
+                'You can queue at most {} songs at once.'.format(
+                    self.QUERY_LIMIT))
+
+        state = ctx.voice_state
+        if not state.voice:
+            await ctx.invoke(self._join)
+
+        inserted = 0
+        # Reported in one message, counted by error.
+        errors = collections.Counter()
+
+        def commit(song: Song):
+            nonlocal inserted
+            if front:
+                state.songs.insert(inserted, song)
+                state.queue_changed()
+                inserted += 1
+            else:
+                state.songs.put_nowait(song)
+
+        async def lookup(query: str) -> Song:
+            info = await self.scheduler.run(
+                ctx.guild.id,
+                functools.partial(YTDLSource.lookup, query),
+                weight=state.priority)
+            return Song(ctx, info)
+
+        async def resolve(query: str) -> typing.Optional[Song]:
+            # Lookups run side by side, songs are queued in request order.
+            try:
+                return await state.resolver.run(
+                    functools.partial(lookup, query), commit)
+            except AdmissionError as e:
+                errors[str(e)] += 1
+            except YTDLError as e:
+                errors['An error occurred while processing this request: {}'.
+                       format(str(e))] += 1
+
+        async with ctx.typing():
+            songs = await asyncio.gather(*map(resolve, queries))
+
+        songs = [song for song in songs if song is not None]
+        lines = []
+        if len(queries) == 1 and songs:
+            lines.append('Enqueued {}'.format(str(songs[0])))
+        elif songs:
+            lines.append('Enqueued **{}** songs.'.format(len(songs)))
+
+        if errors and len(queries) > 1:
+            lines.append('**{}** songs couldn\'t be queued:'.format(
+                sum(errors.values())))
+        for error, count in list(errors.items())[:self.ERROR_LINES]:
+            lines.append(error if count == 1 else '{} (x{})'.format(
+                error, count))
+        if len(errors) > self.ERROR_LINES:
+            lines.append('...and {} other errors.'.format(
+                len(errors) - self.ERROR_LINES))
+
+        if lines:
+            await ctx.send('\n'.join(lines))
+
+    @commands.command(name='playlist', aliases=['pl'])
+    async def _playlist(self, ctx: Context, *, url: str):
+        """Queues the songs of a playlist.
+        The first songs start playing while the rest of the playlist is still being read.
+        """
+
+        if ctx.voice_state.ingestion and not ctx.voice_state.ingestion.done():
+            return await ctx.send(
+                'A playlist is already being queued in this server.')
+
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
+
+        ctx.voice_state.ingestion = self.bot.loop.create_task(
+            self.ingest_playlist(ctx, url))
+        await ctx.message.add_reaction('✅')
+
+    async def ingest_playlist(self, ctx: Context, url: str):
+        state = ctx.voice_state
+        resolving = set()
+        semaphore = asyncio.Semaphore(self.PLAYLIST_CONCURRENCY)
+
+        async def resolve(song: Song):
+            async with semaphore:
+                try:
+                    song.track = await YTDLSource.refresh(song.track)
+                except YTDLError:
+                    # Reported when the song comes up.
+                    pass
+
+        added = 0
+        start = 1
+        page = self.PLAYLIST_FIRST_PAGE
+        retries = 0
+        try:
+            try:
+                while added < self.PLAYLIST_LIMIT:
+                    page = min(page, self.PLAYLIST_LIMIT - added)
+                    try:
+                        entries = await self.scheduler.run(
+                            ctx.guild.id,
+                            functools.partial(YTDLSource.playlist, url, start,
+                                              start + page - 1),
+                            weight=state.priority)
+                    except AdmissionError as e:
+                        if retries == self.PLAYLIST_RETRIES:
+                            await ctx.send(
+                                '{} Stopped reading the playlist after **{}** '
+                                'songs.'.format(str(e), added))
+                            break
+                        if retries == 0:
+                            await ctx.send(
+                                '{} **{}** songs of the playlist are queued, '
+                                'the rest will follow.'.format(str(e), added))
+
+                        await asyncio.sleep(
+                            min(self.PLAYLIST_BACKOFF * 2**retries,
+                                self.PLAYLIST_MAX_BACKOFF))
+                        retries += 1
+                        continue
+
+                    retries = 0
+
+                    for entry in entries:
+                        song = Song(ctx, entry)
+                        await state.songs.put(song)
+                        added += 1
+
+                        if YTDLSource.needs_refresh(entry):
+                            task = self.bot.loop.create_task(resolve(song))
+                            resolving.add(task)
+                            task.add_done_callback(resolving.discard)
+
+                    if len(entries) < page:
+                        break
+
+                    start += page
+                    page = self.PLAYLIST_PAGE
+            except YTDLError as e:
+                await ctx.send(
+                    'An error occurred while processing this request: {}'.
+                    format(str(e)))
+
+            if added:
+                await ctx.send(
+                    'Enqueued **{}** songs from the playlist.'.format(added))
+            await asyncio.gather(*resolving)
+        finally:
+            for task in list(resolving):
+                task.cancel()
+
+    @commands.command(name='musicstats', hidden=True)
+    @commands.is_owner()
+    async def _musicstats(self, ctx: Context):
+        """Shows the internal counters of the music player."""
+
+        entries = [('cache_' + key, value)
+                   for key, value in YTDLSource.cache.stats.items()]
+        entries.extend(('flights_' + key, value)
+                       for key, value in YTDLSource.flights.stats.items())
+        entries.extend(('engine_' + key, value)
+                       for key, value in YTDLSource.engine.stats.items())
+        entries.extend(('audio_cache_' + key, value)
+                       for key, value in YTDLSource.audio_cache.stats.items())
+        entries.extend(('frame_store_' + key, value)
+                       for key, value in YTDLSource.frame_store.stats.items())
+        entries.extend(('frame_pool_' + key, value)
+                       for key, value in YTDLSource.frame_pool.stats.items())
+        entries.extend(('store_' + key, value)
+                       for key, value in YTDLSource.store.stats.items())
+        entries.extend(('loudness_' + key, value)
+                       for key, value in YTDLSource.analyzer.stats.items())
+        entries.extend(('scheduler_' + key, value)
+                       for key, value in self.scheduler.stats.items())
+        entries.extend(('sessions_' + key, value)
+                       for key, value in self.sessions.stats.items())
+        entries.append(('sessions_restored', self.restored))
+        entries.extend(('broadcast_' + key, value)
+                       for key, value in Broadcast.stats().items())
+        if VoiceState.audio_scheduler is not None:
+            entries.extend(
+                ('audio_scheduler_' + key, value)
+                for key, value in VoiceState.audio_scheduler.stats.items())
+        entries.append(('crossfade', ctx.voice_state.crossfade))
+        entries.append(('voice_states', len(self.voice_states)))
+        entries.append(('voice_state_tasks',
+                        sum(len(state.tasks)
+                            for state in self.voice_states.values())))
+        entries.append(('voice_states_reaped', self.reaped))
+        entries.append(('asyncio_tasks', len(asyncio.all_tasks())))
+
+        source = ctx.voice_state.current and ctx.voice_state.current.source
+        if source:
+            entries.extend(('buffer_' + key, value)
+                           for key, value in source.buffer_stats.items())
+            entries.extend(('dsp_' + key, value)
+                           for key, value in source.dsp_stats.items())
+        if ctx.voice_state.stream_stats:
+            entries.extend(
+                ('stream_' + key, value)
+                for key, value in ctx.voice_state.stream_stats.items())
+
+        gaps = [
+            gap for state in self.voice_states.values()
+            for gap in state.transition_gaps
+        ]
+        latencies = YTDLSource.restart_latencies
+        if latencies:
+            entries.append(('restart_latency_avg',
+                            round(sum(latencies) / len(latencies), 3)))
+            entries.append(('restart_latency_max', round(max(latencies), 3)))
+        if gaps:
+            entries.append(('transition_gap_avg',
+                            round(sum(gaps) / len(gaps), 3)))
+            entries.append(('transition_gap_max', round(max(gaps), 3)))
+        await ctx.entry_to_code(entries)
 
     @_join.before_invoke
     @_play.before_invoke
+    @_playnext.before_invoke
+    @_radio.before_invoke
+    @_playlist.before_invoke
     async def ensure_voice_state(self, ctx: Context):
         if not ctx.author.voice or not ctx.author.voice.channel:
             raise commands.CommandError(
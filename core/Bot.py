@@ -3,7 +3,7 @@ from __future__ import annotations
 import discord
 from discord.ext import commands
 
-import aiohttp, jishaku, os
+import asyncio, aiohttp, jishaku, os
 
 os.environ["JISHAKU_HIDE"] = "True"
 os.environ["JISHAKU_NO_UNDERSCORE"] = "True"
@@ -32,6 +32,7 @@ class Bot(commands.Bot):
         self._internal_db = {}
         self._24_7 = set()
         self._specific = set()
+        self._voice_locks = {}
         self.db = Database(self)
 
     async def on_ready(self):
@@ -45,13 +46,26 @@ class Bot(commands.Bot):
                 if not vc:
                     pass
                 else:
-                    try:
-                        await vc.connect()
-                    except Exception:
-                        pass
+                    async with self.voice_lock(vc.guild.id):
+                        # A restored music session may have connected first.
+                        if vc.guild.voice_client is not None:
+                            continue
+                        try:
+                            await vc.connect()
+                        except Exception:
+                            pass
 
         print(f'Ready: {self.user} (ID: {self.user.id})')
 
+    def voice_lock(self, guild_id: int) -> asyncio.Lock:
+        """Held while connecting to a voice channel of a guild, a guild only
+        has one voice client.
+        """
+        lock = self._voice_locks.get(guild_id)
+        if lock is None:
+            lock = self._voice_locks[guild_id] = asyncio.Lock()
+        return lock
+
     def run(self):
         super().run(os.environ['TOKEN'], reconnect=True)
 
@@ -0,0 +1,110 @@
+import random
+
+import pytest
+
+from utils.indexedlist import IndexedList
+
+
+class SmallList(IndexedList):
+    # Small chunks, so that a few dozen items already span many of them.
+    LOAD = 4
+
+
+def test_matches_list_under_random_edits():
+    rng = random.Random(0)
+    items = SmallList(range(50))
+    expected = list(range(50))
+
+    for step in range(2000):
+        op = rng.randrange(6)
+        if op == 0:
+            index = rng.randint(-len(expected) - 2, len(expected) + 2)
+            items.insert(index, step)
+            expected.insert(index, step)
+        elif op == 1:
+            items.append(step)
+            expected.append(step)
+        elif op == 2 and expected:
+            index = rng.randrange(-len(expected), len(expected))
+            assert items.pop(index) == expected.pop(index)
+        elif op == 3 and expected:
+            source = rng.randrange(len(expected))
+            destination = rng.randrange(len(expected))
+            items.move(source, destination)
+            expected.insert(destination, expected.pop(source))
+        elif op == 4:
+            start = rng.randint(-2, len(expected) + 2)
+            stop = rng.randint(-2, len(expected) + 2)
+            items.delete_range(start, stop)
+            del expected[max(0, start):max(0, stop)]
+        elif op == 5:
+            values = range(step, step + rng.randrange(12))
+            items.extend(values)
+            expected.extend(values)
+
+        assert len(items) == len(expected)
+
+    assert list(items) == expected
+    assert list(reversed(items)) == expected[::-1]
+    assert [items[i] for i in range(len(expected))] == expected
+
+
+def test_indexing():
+    items = SmallList(range(20))
+
+    assert items[0] == 0
+    assert items[-1] == 19
+    assert items[5:13] == list(range(5, 13))
+    assert items[::3] == list(range(0, 20, 3))
+    assert items[15:5] == []
+
+    items[7] = 'seven'
+    assert items[7] == 'seven'
+
+    with pytest.raises(IndexError):
+        items[20]
+    with pytest.raises(IndexError):
+        items[-21]
+
+
+def test_delete():
+    items = SmallList(range(20))
+    expected = list(range(20))
+
+    del items[3]
+    del expected[3]
+    del items[2:9]
+    del expected[2:9]
+    del items[::2]
+    del expected[::2]
+    assert list(items) == expected
+
+    items.remove(expected[1])
+    expected.remove(expected[1])
+    assert list(items) == expected
+
+    with pytest.raises(ValueError):
+        items.remove('missing')
+
+
+def test_popleft_empties():
+    items = SmallList(range(10))
+
+    assert [items.popleft() for _ in range(10)] == list(range(10))
+    assert not items
+    with pytest.raises(IndexError):
+        items.popleft()
+
+    items.append('again')
+    assert list(items) == ['again']
+
+
+def test_shuffle_and_clear():
+    items = SmallList(range(100))
+
+    items.shuffle()
+    assert sorted(items) == list(range(100))
+
+    items.clear()
+    assert len(items) == 0
+    assert list(items) == []
@@ -0,0 +1,246 @@
+import asyncio
+
+import pytest
+
+from utils.scheduler import AdmissionError, FairScheduler, OrderedPipeline
+
+
+def job(order, name, gate=None):
+    async def run():
+        if gate is not None:
+            await gate.wait()
+        order.append(name)
+        return name
+    return run
+
+
+def test_concurrency_is_bounded():
+    async def main():
+        scheduler = FairScheduler(concurrency=2, per_key_limit=10)
+        running = peak = 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(scheduler.run(key % 3, work)
+                               for key in range(9)))
+        assert peak == 2
+        assert scheduler.stats['running'] == 0
+        assert scheduler.stats['admitted'] == 9
+
+    asyncio.run(main())
+
+
+def test_keys_take_turns():
+    async def main():
+        scheduler = FairScheduler(concurrency=1, per_key_limit=10)
+        order = []
+        gate = asyncio.Event()
+
+        tasks = [
+            asyncio.ensure_future(
+                scheduler.run('a', job(order, 'a', gate if i == 0 else None)))
+            for i in range(6)
+        ]
+        await asyncio.sleep(0)
+        tasks += [
+            asyncio.ensure_future(scheduler.run('b', job(order, 'b')))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(*tasks)
+
+        # b arrived last but doesn't wait for all of a's jobs.
+        assert order == ['a', 'a', 'b', 'a', 'b', 'a', 'a', 'a']
+
+    asyncio.run(main())
+
+
+def test_weight_shares_slots():
+    async def main():
+        scheduler = FairScheduler(concurrency=1, per_key_limit=10)
+        order = []
+        gate = asyncio.Event()
+
+        first = asyncio.ensure_future(
+            scheduler.run('gate', job(order, 'gate', gate)))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.ensure_future(
+                scheduler.run('heavy', job(order, 'heavy'), weight=2.0))
+            for _ in range(4)
+        ] + [
+            asyncio.ensure_future(scheduler.run('light', job(order, 'light')))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(first, *tasks)
+
+        # Twice the weight, twice the turns.
+        assert order == [
+            'gate', 'heavy', 'heavy', 'light', 'heavy', 'heavy', 'light'
+        ]
+
+    asyncio.run(main())
+
+
+def test_admission_limits():
+    async def main():
+        scheduler = FairScheduler(concurrency=1,
+                                  per_key_limit=2,
+                                  global_limit=3)
+        gate = asyncio.Event()
+        tasks = [
+            asyncio.ensure_future(scheduler.run('a', job([], 'a', gate)))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionError):
+            await scheduler.run('a', job([], 'a'))
+        assert scheduler.pending('a') == 2
+
+        tasks.append(
+            asyncio.ensure_future(scheduler.run('b', job([], 'b', gate))))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionError):
+            await scheduler.run('c', job([], 'c'))
+
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert scheduler.stats['rejected'] == 2
+        assert scheduler.pending('a') == 0
+
+    asyncio.run(main())
+
+
+def test_cancel_and_errors_free_their_slot():
+    async def main():
+        scheduler = FairScheduler(concurrency=1, per_key_limit=10)
+        gate = asyncio.Event()
+        order = []
+
+        async def fail():
+            raise ValueError('boom')
+
+        blocker = asyncio.ensure_future(
+            scheduler.run('a', job(order, 'first', gate)))
+        await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(scheduler.run('b', job(order, 'x')))
+        failing = asyncio.ensure_future(scheduler.run('c', fail))
+        last = asyncio.ensure_future(scheduler.run('d', job(order, 'last')))
+        await asyncio.sleep(0)
+
+        waiting.cancel()
+        gate.set()
+        await blocker
+        with pytest.raises(ValueError):
+            await failing
+        await last
+
+        assert waiting.cancelled()
+        assert order == ['first', 'last']
+        stats = scheduler.stats
+        assert (stats['running'], stats['waiting'], stats['keys']) == (0, 0, 0)
+
+    asyncio.run(main())
+
+
+def delayed(delay, value):
+    async def run():
+        await asyncio.sleep(delay)
+        return value
+    return run
+
+
+def test_pipeline_commits_in_order():
+    async def main():
+        pipeline = OrderedPipeline(concurrency=4)
+        committed = []
+
+        results = await asyncio.gather(*(
+            pipeline.run(delayed(delay, value), committed.append)
+            for value, delay in enumerate((0.04, 0.01, 0.03, 0.0))))
+
+        assert committed == [0, 1, 2, 3]
+        assert results == [0, 1, 2, 3]
+        assert pipeline.pending == 0
+
+    asyncio.run(main())
+
+
+def test_pipeline_concurrency_is_bounded():
+    async def main():
+        pipeline = OrderedPipeline(concurrency=2)
+        running = peak = 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(pipeline.run(work, lambda result: None)
+                               for _ in range(6)))
+        assert peak == 2
+
+    asyncio.run(main())
+
+
+def test_pipeline_skips_failed_and_cancelled_jobs():
+    async def main():
+        pipeline = OrderedPipeline(concurrency=4)
+        committed = []
+
+        async def fail():
+            await asyncio.sleep(0.02)
+            raise ValueError('boom')
+
+        tasks = [
+            asyncio.ensure_future(pipeline.run(delayed(0.01, 0),
+                                               committed.append)),
+            asyncio.ensure_future(pipeline.run(fail, committed.append)),
+            asyncio.ensure_future(pipeline.run(delayed(1, 2),
+                                               committed.append)),
+            asyncio.ensure_future(pipeline.run(delayed(0, 3),
+                                               committed.append)),
+        ]
+        await asyncio.sleep(0.005)
+        tasks[2].cancel()
+
+        with pytest.raises(ValueError):
+            await tasks[1]
+        assert await tasks[3] == 3
+        assert committed == [0, 3]
+        assert tasks[2].cancelled()
+        assert pipeline.pending == 0
+
+    asyncio.run(main())
+
+
+def test_pipeline_commit_error_is_raised_to_its_job():
+    async def main():
+        pipeline = OrderedPipeline(concurrency=2)
+        committed = []
+
+        def commit(value):
+            if value == 0:
+                raise RuntimeError('full')
+            committed.append(value)
+
+        first = asyncio.ensure_future(pipeline.run(delayed(0, 0), commit))
+        second = asyncio.ensure_future(pipeline.run(delayed(0, 1), commit))
+
+        with pytest.raises(RuntimeError):
+            await first
+        assert await second == 1
+        assert committed == [1]
+
+    asyncio.run(main())
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import collections, queue, threading, time, typing
+
+import discord
+
+__all__ = ('BufferFiller', 'BufferedAudioSource')
+
+# Seconds of audio in one frame.
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class BufferedAudioSource(discord.AudioSource):
+    """Reads the frames of another source ahead on its own thread.
+
+    The player reads from the buffer, so short stalls of the source don't
+    reach the listeners. The buffer targets a depth that covers the longest
+    recent stall of the source, between ``min_frames`` and ``max_frames``.
+
+    When the source lends its frames (it has a ``release`` method, see
+    utils/frames.py), a frame is given back once the next one is read, so
+    it's only valid until then.
+
+    The buffer is topped up to its target once it has drained to half of
+    it, rather than after every frame read. It's filled by its own thread,
+    or by the threads of a shared BufferFiller when one is given.
+    """
+    # Per frame decay of the remembered stall, it halves in about 14 seconds.
+    DECAY = 0.9995
+
+    def __init__(self,
+                 source: discord.AudioSource,
+                 *,
+                 min_frames: int = 10,
+                 max_frames: int = 150,
+                 filler: typing.Optional[BufferFiller] = None):
+        self.source = source
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.target = min_frames
+        self.filler = filler
+
+        self._frames: typing.Deque[bytes] = collections.deque()
+        self._cond = threading.Condition()
+        self._done = False
+        self._closed = False
+        self._started = False
+        # Whether a refill has been asked for and hasn't finished yet.
+        self._wanted = True
+        self._stall = 0.0
+        self._release = getattr(source, 'release', None)
+        self._lent = None
+
+        self.underruns = 0
+
+        if filler is not None:
+            filler.request(self)
+        else:
+            threading.Thread(target=self._fill,
+                             name='audio-buffer',
+                             daemon=True).start()
+
+    @property
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'fill': len(self._frames),
+            'target': self.target,
+            'underruns': self.underruns,
+            'stall_ms': round(self._stall * 1000),
+        }
+
+    def _observe(self, elapsed: float) -> None:
+        self._stall = max(elapsed, self._stall * self.DECAY)
+        target = self.min_frames + int(self._stall / FRAME_LENGTH * 1.5)
+        self.target = min(self.max_frames, target)
+
+    def _fill(self) -> None:
+        while True:
+            with self._cond:
+                while not self._wanted and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+            if not self._refill():
+                return
+
+    def _refill(self) -> bool:
+        """Reads frames until the target is reached. Returns ``False`` once
+        the source has ended or the buffer has been closed.
+        """
+        while True:
+            with self._cond:
+                if self._closed or self._done:
+                    self._wanted = False
+                    return False
+                if len(self._frames) >= self.target:
+                    self._wanted = False
+                    return True
+
+            start = time.perf_counter()
+            try:
+                data = self.source.read()
+            except Exception:
+                # The source was cleaned up while we were reading it.
+                data = b''
+            self._observe(time.perf_counter() - start)
+
+            with self._cond:
+                if data:
+                    self._frames.append(data)
+                else:
+                    self._done = True
+                self._cond.notify_all()
+
+    def ready(self) -> bool:
+        """Whether ``read`` returns without waiting for the source."""
+        return bool(self._frames) or self._done or self._closed
+
+    def read(self) -> bytes:
+        with self._cond:
+            if not self._frames and not self._done and self._started:
+                self.underruns += 1
+
+            while not self._frames and not self._done and not self._closed:
+                self._cond.wait()
+
+            if not self._frames:
+                return b''
+
+            self._started = True
+            data = self._frames.popleft()
+            if not self._wanted and len(self._frames) <= self.target // 2:
+                self._wanted = True
+                if self.filler is not None:
+                    self.filler.request(self)
+                else:
+                    self._cond.notify_all()
+
+            if self._release is not None:
+                if self._lent is not None:
+                    self._release(self._lent)
+                self._lent = data
+            return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self) -> None:
+        with self._cond:
+            self._closed = True
+            if self._release is not None:
+                # The lent frame may still be in use, it's left to the GC.
+                for frame in self._frames:
+                    self._release(frame)
+            self._frames.clear()
+            self._cond.notify_all()
+        self.source.cleanup()
+
+
+class BufferFiller:
+    """Fills the BufferedAudioSources of many streams from ``threads``
+    threads, instead of a thread per buffer.
+
+    A buffer asks for a refill once it has drained to half its target, and
+    a thread then reads frames until it's full again. A source stalled in
+    the middle of a read holds up the thread reading it until FFmpeg gives
+    up on the stream, the other threads keep filling the other buffers.
+    """
+    def __init__(self, threads: int = 4):
+        self.threads = threads
+        self._work: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._started = False
+
+        self.refills = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'threads': self.threads,
+            'refills': self.refills,
+        }
+
+    def request(self, buffer: BufferedAudioSource) -> None:
+        with self._lock:
+            if not self._started:
+                self._started = True
+                for i in range(self.threads):
+                    threading.Thread(target=self._worker,
+                                     name='audio-filler-{}'.format(i),
+                                     daemon=True).start()
+        self._work.put(buffer)
+
+    def _worker(self) -> None:
+        while True:
+            buffer = self._work.get()
+            if buffer is None:
+                return
+
+            self.refills += 1
+            buffer._refill()
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._started:
+                return
+        for _ in range(self.threads):
+            self._work.put(None)
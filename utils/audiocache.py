@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import asyncio, hashlib, os, subprocess, time, typing
+
+from utils.cache import normalize_query
+from utils.track import Track
+
+__all__ = ('AudioCache', )
+
+
+class _CachedFile:
+    __slots__ = ('path', 'size', 'hits', 'last_used')
+
+    def __init__(self, path: str, size: int, last_used: float):
+        self.path = path
+        self.size = size
+        self.hits = 0
+        self.last_used = last_used
+
+
+class AudioCache:
+    """Frequently played tracks transcoded to Ogg Opus files on disk.
+
+    A track is copied once it has been played ``min_plays`` times. When the
+    cache grows over ``max_bytes``, the least frequently used files go first,
+    the least recently used among those.
+    """
+    EXTENSION = '.ogg'
+
+    def __init__(self,
+                 directory: str,
+                 *,
+                 max_bytes: int = 2 * 1024**3,
+                 min_plays: int = 3,
+                 max_duration: int = 20 * 60,
+                 concurrency: int = 2,
+                 executable: str = 'ffmpeg'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        self.concurrency = concurrency
+        self.executable = executable
+
+        self._files: typing.Dict[str, _CachedFile] = {}
+        self._plays: OrderedDict[str, int] = OrderedDict()
+        self._filling: typing.Dict[str, asyncio.Task] = {}
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+        self._bytes = 0
+        self._loaded = False
+
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.evictions = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'files': len(self._files),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'filling': len(self._filling),
+            'fills': self.fills,
+            'evictions': self.evictions,
+        }
+
+    @staticmethod
+    def key(webpage_url: str) -> str:
+        return hashlib.sha1(
+            normalize_query(webpage_url).encode()).hexdigest()
+
+    def _load(self) -> None:
+        # Picks up the files cached before the last restart.
+        self._loaded = True
+        if not os.path.isdir(self.directory):
+            return
+
+        for entry in os.scandir(self.directory):
+            key, ext = os.path.splitext(entry.name)
+            if ext == '.part':
+                os.remove(entry.path)
+            elif ext == self.EXTENSION:
+                stat = entry.stat()
+                self._files[key] = _CachedFile(entry.path, stat.st_size,
+                                               stat.st_mtime)
+                self._bytes += stat.st_size
+
+        self._evict()
+
+    def lookup(self, webpage_url: str) -> typing.Optional[str]:
+        """Returns the path of the cached file of a track, if any."""
+        if not self._loaded:
+            self._load()
+
+        cached = self._files.get(self.key(webpage_url))
+        if cached is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        cached.hits += 1
+        cached.last_used = time.time()
+        return cached.path
+
+    def record_play(self, track: Track) -> None:
+        """Counts a play of a streamed track, caching it once it's popular."""
+        key = self.key(track.webpage_url)
+        plays = self._plays.pop(key, 0) + 1
+        self._plays[key] = plays
+        while len(self._plays) > 10000:
+            self._plays.popitem(last=False)
+
+        duration = track.duration
+        if (plays >= self.min_plays and key not in self._files
+                and key not in self._filling and track.url and duration
+                and duration <= self.max_duration):
+            task = asyncio.ensure_future(self._fill(key, track.url))
+            self._filling[key] = task
+            task.add_done_callback(lambda _: self._filling.pop(key, None))
+
+    async def _fill(self, key: str, stream_url: str) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        path = os.path.join(self.directory, key + self.EXTENSION)
+        partial = os.path.join(self.directory, key + '.part')
+
+        async with self._semaphore:
+            os.makedirs(self.directory, exist_ok=True)
+            process = await asyncio.create_subprocess_exec(
+                self.executable, '-nostdin', '-loglevel', 'error',
+                '-reconnect', '1', '-reconnect_streamed', '1',
+                '-reconnect_delay_max', '5', '-i', stream_url, '-vn',
+                '-c:a', 'libopus', '-b:a', '128k', '-f', 'ogg', '-y', partial,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            code = None
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+            finally:
+                if code != 0 and os.path.exists(partial):
+                    os.remove(partial)
+
+        if code == 0:
+            os.replace(partial, path)
+            size = os.path.getsize(path)
+            self._files[key] = _CachedFile(path, size, time.time())
+            self._bytes += size
+            self.fills += 1
+            self._evict()
+
+    def discard(self, webpage_url: str) -> None:
+        cached = self._files.pop(self.key(webpage_url), None)
+        if cached is not None:
+            self._remove(cached)
+
+    def _remove(self, cached: _CachedFile) -> None:
+        self._bytes -= cached.size
+        try:
+            # FFmpeg processes still reading the file keep it open.
+            os.remove(cached.path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._files:
+            key = min(self._files,
+                      key=lambda k:
+                      (self._files[k].hits, self._files[k].last_used))
+            self._remove(self._files.pop(key))
+            self.evictions += 1
+
+    def close(self) -> None:
+        for task in list(self._filling.values()):
+            task.cancel()
@@ -0,0 +1,306 @@
+from __future__ import annotations
+
+import asyncio, queue, threading, time, typing
+
+import discord
+
+from utils.audio import FRAME_LENGTH, BufferFiller
+
+__all__ = ('AudioScheduler', 'ScheduledStream')
+
+
+class ScheduledStream:
+    """A source played to a voice client by an AudioScheduler, in place of
+    the AudioPlayer thread discord.py would start for it.
+    """
+    def __init__(self, scheduler: AudioScheduler, slot: int,
+                 voice: discord.VoiceClient, source: discord.AudioSource,
+                 after: typing.Optional[typing.Callable[
+                     [typing.Optional[Exception]], typing.Any]]):
+        self.scheduler = scheduler
+        self.slot = slot
+        self.voice = voice
+        self.source = source
+        self.after = after
+
+        self.frames = 0
+        self.misses = 0
+        self.underruns = 0
+        self.max_late = 0.0
+
+        self._paused = False
+        self._done = False
+        self._speaking = False
+        self._busy = False
+        self._error: typing.Optional[Exception] = None
+
+    @property
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'frames': self.frames,
+            'deadline_misses': self.misses,
+            'underruns': self.underruns,
+            'max_late_ms': round(self.max_late * 1000, 1),
+        }
+
+    def is_playing(self) -> bool:
+        return not self._done and not self._paused
+
+    def is_paused(self) -> bool:
+        return not self._done and self._paused
+
+    def pause(self) -> None:
+        self._paused = True
+        self._speak(False)
+
+    def resume(self) -> None:
+        self._paused = False
+
+    def stop(self) -> None:
+        # The stream is cleaned up by its next turn, never during a read.
+        self._done = True
+
+    def _speak(self, speaking: bool) -> None:
+        if speaking == self._speaking:
+            return
+
+        self._speaking = speaking
+        try:
+            asyncio.run_coroutine_threadsafe(self.voice.ws.speak(speaking),
+                                             self.voice.loop)
+        except Exception:
+            pass
+
+    def _step(self, deadline: float) -> None:
+        if self._done:
+            return self._finish()
+
+        if self._paused:
+            return
+
+        if not self.voice.is_connected():
+            if self.voice.guild.voice_client is not self.voice:
+                # Disconnected for good, discord.py only stops the player
+                # of the voice client itself.
+                self._done = True
+                return self._finish()
+            # Waits for the reconnect, like AudioPlayer does.
+            return
+
+        ready = getattr(self.source, 'ready', None)
+        if ready is not None and not ready():
+            # Reading would wait for the source while holding a worker
+            # the other streams need, the frame is skipped instead.
+            self.underruns += 1
+            self.scheduler.underruns += 1
+            return
+
+        try:
+            data = self.source.read()
+            if not data:
+                self._done = True
+                return self._finish()
+
+            self._speak(True)
+            self.voice.send_audio_packet(data,
+                                         encode=not self.source.is_opus())
+        except Exception as e:
+            self._error = e
+            self._done = True
+            return self._finish()
+
+        self.frames += 1
+        late = time.perf_counter() - deadline
+        self.max_late = max(self.max_late, late)
+        if late > self.scheduler.tolerance:
+            self.misses += 1
+            self.scheduler.misses += 1
+
+    def _finish(self) -> None:
+        if not self.scheduler._remove(self):
+            # Already finished by another worker.
+            return
+
+        self._speak(False)
+        try:
+            self.source.cleanup()
+        finally:
+            if self.after is not None:
+                self.after(self._error)
+
+
+class AudioScheduler:
+    """Plays the sources of many voice clients from a few threads.
+
+    discord.py starts a thread per voice client, each sleeping through its
+    own 20 ms cadence. Here one clock thread walks a timing wheel of
+    ``resolution`` long slots, a frame long in total. Every stream sits in
+    a slot and is due once per turn of the wheel. Due streams go to a fixed
+    pool of ``threads`` workers. A frame sent more than ``tolerance``
+    seconds after its deadline is counted as a miss.
+
+    Workers never wait for a source: a source with a ``ready`` method (see
+    BufferedAudioSource) is only read once it has a frame, an empty one
+    skips its turn and counts an underrun. The buffers of the sources
+    played here are meant to be filled by ``filler``, ``fill_threads``
+    threads shared by every stream.
+    """
+    def __init__(self,
+                 threads: int = 2,
+                 *,
+                 fill_threads: int = 4,
+                 resolution: float = 0.001,
+                 tolerance: float = 0.01):
+        self.threads = threads
+        self.filler = BufferFiller(fill_threads)
+        self.slots = max(1, round(FRAME_LENGTH / resolution))
+        self.resolution = FRAME_LENGTH / self.slots
+        self.tolerance = tolerance
+
+        self._wheel: typing.List[typing.Set[ScheduledStream]] = [
+            set() for _ in range(self.slots)
+        ]
+        self._count = 0
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._work: queue.SimpleQueue = queue.SimpleQueue()
+        self._started = False
+        self._closed = False
+
+        self.frames_due = 0
+        self.skipped = 0
+        self.misses = 0
+        self.underruns = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        stats = {
+            'threads': self.threads,
+            'streams': self._count,
+            'frames_due': self.frames_due,
+            'skipped': self.skipped,
+            'deadline_misses': self.misses,
+            'underruns': self.underruns,
+        }
+        stats.update(('filler_' + key, value)
+                     for key, value in self.filler.stats.items())
+        return stats
+
+    def _start(self) -> None:
+        self._started = True
+        threading.Thread(target=self._clock,
+                         name='audio-scheduler-clock',
+                         daemon=True).start()
+        for i in range(self.threads):
+            threading.Thread(target=self._worker,
+                             name='audio-scheduler-{}'.format(i),
+                             daemon=True).start()
+
+    def play(
+        self,
+        voice: discord.VoiceClient,
+        source: discord.AudioSource,
+        *,
+        after: typing.Optional[typing.Callable[[typing.Optional[Exception]],
+                                               typing.Any]] = None
+    ) -> ScheduledStream:
+        """Starts playing ``source`` to ``voice``, the way
+        ``VoiceClient.play`` does.
+        """
+        if self._closed:
+            raise RuntimeError('The audio scheduler is closed.')
+        if not voice.is_connected():
+            raise discord.ClientException('Not connected to voice.')
+
+        if not source.is_opus() and not voice.encoder:
+            voice.encoder = discord.opus.Encoder()
+
+        with self._lock:
+            # The emptiest slot, to spread the sends over the frame.
+            slot = min(range(self.slots), key=lambda i: len(self._wheel[i]))
+            stream = ScheduledStream(self, slot, voice, source, after)
+            self._wheel[slot].add(stream)
+            self._count += 1
+            if not self._started:
+                self._start()
+            self._active.set()
+
+        return stream
+
+    def _remove(self, stream: ScheduledStream) -> bool:
+        with self._lock:
+            if stream not in self._wheel[stream.slot]:
+                return False
+            self._wheel[stream.slot].discard(stream)
+            self._count -= 1
+            return True
+
+    def _clock(self) -> None:
+        while not self._closed:
+            self._active.wait()
+            start = time.perf_counter()
+            tick = 0
+
+            while not self._closed:
+                with self._lock:
+                    if not self._count:
+                        self._active.clear()
+                        break
+                    # Empty slots are skipped rather than slept through one
+                    # by one.
+                    while not self._wheel[tick % self.slots]:
+                        tick += 1
+                    due = list(self._wheel[tick % self.slots])
+
+                deadline = start + tick * self.resolution
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -FRAME_LENGTH * 5:
+                    # Far behind, catching up would only burst packets.
+                    start = time.perf_counter()
+                    tick = 0
+                    continue
+
+                for stream in due:
+                    self.frames_due += 1
+                    if stream._busy:
+                        # Its last frame is still being read or sent.
+                        self.skipped += 1
+                        stream.misses += 1
+                        self.misses += 1
+                        continue
+
+                    stream._busy = True
+                    self._work.put((stream, deadline))
+                tick += 1
+
+    def _worker(self) -> None:
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+
+            stream, deadline = item
+            try:
+                stream._step(deadline)
+            except Exception:
+                # Raised by the after callback, the stream is done anyway.
+                pass
+            finally:
+                stream._busy = False
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            streams = [stream for slot in self._wheel for stream in slot]
+            self._active.set()
+
+        for stream in streams:
+            stream.stop()
+        # Workers finish what's queued, ending the stopped streams, and exit.
+        for stream in streams:
+            self._work.put((stream, time.perf_counter()))
+        for _ in range(self.threads if self._started else 0):
+            self._work.put(None)
+        self.filler.close()
@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+import asyncio, functools, time, typing
+
+from utils.track import FIELDS, Track
+
+__all__ = ('ExtractionCache', 'SingleFlight', 'normalize_query',
+           'stream_expiry')
+
+def normalize_query(query: str) -> str:
+    """Returns the cache key of a search query or URL."""
+    query = query.strip().strip('<>')
+    if '://' in query:
+        # Video ids are case sensitive, only the scheme and host are not.
+        parsed = urlparse(query)
+        return parsed._replace(scheme=parsed.scheme.lower(),
+                               netloc=parsed.netloc.lower()).geturl()
+    return ' '.join(query.casefold().split())
+
+
+def stream_expiry(url: typing.Optional[str]) -> typing.Optional[float]:
+    """Returns the unix time a signed stream URL expires at, if it has one."""
+    if not url:
+        return None
+
+    try:
+        expire = parse_qs(urlparse(url).query).get('expire')
+        if expire is None:
+            # googlevideo sometimes puts the parameters in the path instead.
+            parts = urlparse(url).path.split('/')
+            expire = [parts[parts.index('expire') + 1]]
+        return float(expire[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def slim_info(info: dict) -> dict:
+    """Drops the keys of an info dict that don't make it into a Track."""
+    return {key: info[key] for key in FIELDS if key in info}
+
+
+def _sizeof(obj: typing.Any) -> int:
+    # A rough estimate is enough for keeping the cache under its budget.
+    if isinstance(obj, str):
+        return 49 + len(obj)
+    if isinstance(obj, Track):
+        return 16 + 8 * len(FIELDS) + sum(
+            _sizeof(getattr(obj, field)) for field in FIELDS)
+    if isinstance(obj, dict):
+        return 64 + sum(
+            _sizeof(k) + _sizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return 56 + sum(_sizeof(v) for v in obj)
+    return 28
+
+
+class _Entry:
+    __slots__ = ('info', 'size', 'expires', 'aliases')
+
+    def __init__(self, info: Track, size: int, expires: float):
+        self.info = info
+        self.size = size
+        self.expires = expires
+        self.aliases: typing.Set[str] = set()
+
+
+class ExtractionCache:
+    """An LRU cache of extracted track info.
+
+    Entries are stored once under their ``webpage_url``, the queries that
+    resolved to them are kept as aliases. An entry never outlives the stream
+    URL it contains.
+    """
+    def __init__(self,
+                 *,
+                 max_entries: int = 2048,
+                 max_bytes: int = 16 * 1024 * 1024,
+                 ttl: float = 3600.0,
+                 expiry_margin: float = 600.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._aliases: typing.Dict[str, str] = {}
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        return self.get(key, count=False) is not None
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    @property
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'aliases': len(self._aliases),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def _resolve(self, key: str) -> str:
+        key = normalize_query(key)
+        return self._aliases.get(key, key)
+
+    def get(self, key: str, *, count: bool = True) -> typing.Optional[Track]:
+        """Looks up a query or a webpage URL."""
+        url = self._resolve(key)
+        entry = self._entries.get(url)
+
+        if entry is not None and entry.expires <= time.time():
+            self._drop(url)
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+
+        self._entries.move_to_end(url)
+        if count:
+            self.hits += 1
+        return entry.info
+
+    def put(self, query: typing.Optional[str],
+            info: typing.Union[dict, Track]) -> Track:
+        """Stores ``info`` and records ``query`` as an alias of it.
+
+        Returns the track that was actually cached.
+        """
+        if not isinstance(info, Track):
+            info = Track.from_info(info)
+        url = normalize_query(info.webpage_url)
+
+        now = time.time()
+        expires = now + self.ttl
+        stream_expires = stream_expiry(info.url)
+        if stream_expires is not None:
+            expires = min(expires, stream_expires - self.expiry_margin)
+        if expires <= now:
+            return info
+
+        entry = _Entry(info, _sizeof(info), expires)
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self._bytes -= old.size
+            entry.aliases = old.aliases
+        self._entries[url] = entry
+        self._bytes += entry.size
+
+        if query is not None:
+            key = normalize_query(query)
+            if key != url:
+                self._aliases[key] = url
+                entry.aliases.add(key)
+
+        self._shrink()
+        return info
+
+    def alias(self, query: str, webpage_url: str) -> None:
+        """Records that ``query`` resolves to an already cached URL."""
+        url = normalize_query(webpage_url)
+        key = normalize_query(query)
+        entry = self._entries.get(url)
+        if entry is not None and key != url:
+            self._aliases[key] = url
+            entry.aliases.add(key)
+
+    def invalidate(self, key: str) -> None:
+        url = self._resolve(key)
+        if url in self._entries:
+            self._drop(url)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._aliases.clear()
+        self._bytes = 0
+
+    def _drop(self, url: str) -> None:
+        entry = self._entries.pop(url)
+        self._bytes -= entry.size
+        for key in entry.aliases:
+            if self._aliases.get(key) == url:
+                del self._aliases[key]
+
+    def _shrink(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self._bytes > self.max_bytes):
+            url = next(iter(self._entries))
+            self._drop(url)
+            self.evictions += 1
+
+
+class SingleFlight:
+    """Runs at most one coroutine per key at a time.
+
+    Callers asking for a key that is already in flight wait on the same
+    task instead of starting their own. A caller being cancelled does not
+    cancel the shared task, but an exception or cancellation of the task
+    itself is raised in every caller.
+    """
+    def __init__(self):
+        self._calls: typing.Dict[typing.Hashable, asyncio.Future] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'in_flight': len(self._calls),
+            'started': self.started,
+            'coalesced': self.coalesced,
+        }
+
+    async def do(self, key: typing.Hashable,
+                 factory: typing.Callable[[], typing.Awaitable[typing.Any]]):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def _done(self, key: typing.Hashable, task: asyncio.Future) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Every waiter may have gone away already, retrieve the
+            # exception so it isn't reported as never retrieved.
+            task.exception()
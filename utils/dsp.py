@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import ctypes, math, typing
+
+import discord
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Everything but transform and ffmpeg_filters needs NumPy.
+AVAILABLE = numpy is not None
+
+__all__ = ('AVAILABLE', 'EQ_PRESETS', 'Equalizer', 'DSPAudioSource',
+           'CrossfadeSource', 'ffmpeg_filters', 'transform')
+
+SAMPLE_RATE = discord.opus.Encoder.SAMPLING_RATE
+CHANNELS = discord.opus.Encoder.CHANNELS
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+# Bands of each preset: filter kind, frequency (Hz), gain (dB) and Q.
+EQ_PRESETS = {
+    'flat': (),
+    'bass': (('lowshelf', 100, 6.0, 0.707), ),
+    'treble': (('highshelf', 8000, 5.0, 0.707), ),
+    'vocal': (('lowshelf', 150, -3.0, 0.707), ('peaking', 2500, 4.0, 1.0)),
+    'loudness': (('lowshelf', 80, 5.0, 0.707), ('highshelf', 10000, 3.0,
+                                                0.707)),
+    'night': (('lowshelf', 120, -6.0, 0.707), ('highshelf', 9000, -3.0,
+                                               0.707)),
+}
+
+_FFMPEG_FILTERS = {
+    'peaking': 'equalizer',
+    'lowshelf': 'lowshelf',
+    'highshelf': 'highshelf',
+}
+
+
+def ffmpeg_filters(preset: str) -> str:
+    """The FFmpeg audio filters equivalent to an equalizer preset, for the
+    passthrough mode where frames never reach Python.
+    """
+    return ','.join('{}=f={}:t=q:w={}:g={}'.format(_FFMPEG_FILTERS[kind],
+                                                 freq, q, gain)
+                    for kind, freq, gain, q in EQ_PRESETS[preset])
+
+
+def _biquad(kind: str, freq: float, gain: float, q: float,
+            rate: int) -> typing.Tuple[float, ...]:
+    """Normalized coefficients ``(b0, b1, b2, a1, a2)`` of the Audio EQ
+    Cookbook filters.
+    """
+    a = 10**(gain / 40)
+    w0 = 2 * math.pi * freq / rate
+    cos = math.cos(w0)
+    alpha = math.sin(w0) / (2 * q)
+
+    if kind == 'peaking':
+        b = (1 + alpha * a, -2 * cos, 1 - alpha * a)
+        den = (1 + alpha / a, -2 * cos, 1 - alpha / a)
+    elif kind == 'lowshelf':
+        k = 2 * math.sqrt(a) * alpha
+        b = (a * ((a + 1) - (a - 1) * cos + k),
+             2 * a * ((a - 1) - (a + 1) * cos),
+             a * ((a + 1) - (a - 1) * cos - k))
+        den = ((a + 1) + (a - 1) * cos + k, -2 * ((a - 1) + (a + 1) * cos),
+               (a + 1) + (a - 1) * cos - k)
+    elif kind == 'highshelf':
+        k = 2 * math.sqrt(a) * alpha
+        b = (a * ((a + 1) + (a - 1) * cos + k),
+             -2 * a * ((a - 1) + (a + 1) * cos),
+             a * ((a + 1) + (a - 1) * cos - k))
+        den = ((a + 1) - (a - 1) * cos + k, 2 * ((a - 1) - (a + 1) * cos),
+               (a + 1) - (a - 1) * cos - k)
+    else:
+        raise ValueError('Unknown filter kind {!r}'.format(kind))
+
+    return (b[0] / den[0], b[1] / den[0], b[2] / den[0], den[1] / den[0],
+            den[2] / den[0])
+
+
+class Equalizer:
+    """A cascade of biquads, run a block of samples at a time.
+
+    The biquads (transposed direct form II) are merged into one linear
+    system with two states per biquad. Over a block of ``BLOCK`` samples
+    its output is ``T @ x + O @ s`` and its next state ``P @ s + Q @ x``,
+    where ``T`` is the Toeplitz matrix of the impulse response. A frame is
+    filtered with a few matrix products instead of a loop over samples.
+    """
+    # Divides a frame, the fastest of the sizes from 48 to 960 samples.
+    BLOCK = 240
+
+    def __init__(self,
+                 bands: typing.Sequence[typing.Tuple[str, float, float,
+                                                     float]],
+                 *,
+                 rate: int = SAMPLE_RATE,
+                 channels: int = CHANNELS):
+        sections = [_biquad(*band, rate=rate) for band in bands]
+        order = 2 * len(sections)
+
+        def step(state, x):
+            state = list(state)
+            for i, (b0, b1, b2, a1, a2) in enumerate(sections):
+                s1, s2 = state[2 * i], state[2 * i + 1]
+                y = b0 * x + s1
+                state[2 * i] = b1 * x - a1 * y + s2
+                state[2 * i + 1] = b2 * x - a2 * y
+                x = y
+            return state, x
+
+        # The state space form of the cascade, one column at a time.
+        a = numpy.zeros((order, order))
+        c = numpy.zeros(order)
+        for j in range(order):
+            unit = [0.0] * order
+            unit[j] = 1.0
+            a[:, j], c[j] = step(unit, 0.0)
+        b, d = step([0.0] * order, 1.0)
+        b = numpy.array(b)
+
+        n = self.BLOCK
+        powers = [numpy.eye(order)]
+        for _ in range(n):
+            powers.append(a @ powers[-1])
+
+        response = [d] + [c @ powers[k - 1] @ b for k in range(1, n)]
+        self._t = numpy.zeros((n, n))
+        for i in range(n):
+            self._t[i, :i + 1] = response[i::-1]
+        self._o = numpy.array([c @ powers[i] for i in range(n)])
+        self._q = numpy.array([powers[n - 1 - j] @ b for j in range(n)]).T
+        self._p = powers[n]
+
+        self._state = numpy.zeros((order, channels))
+        self._next = numpy.zeros((order, channels))
+        self._feed = numpy.zeros((order, channels))
+        self._y = numpy.zeros((n, channels))
+        self._carry = numpy.zeros((n, channels))
+
+    def process(self, frame: numpy.ndarray) -> None:
+        """Filters ``frame``, shaped ``(samples, channels)``, in place."""
+        n = self.BLOCK
+        for i in range(0, len(frame), n):
+            x = frame[i:i + n]
+            numpy.matmul(self._t, x, out=self._y)
+            numpy.matmul(self._o, self._state, out=self._carry)
+            numpy.add(self._y, self._carry, out=self._y)
+
+            numpy.matmul(self._p, self._state, out=self._next)
+            numpy.matmul(self._q, x, out=self._feed)
+            numpy.add(self._next, self._feed, out=self._state)
+            numpy.copyto(x, self._y)
+
+
+class DSPAudioSource(discord.AudioSource):
+    """Applies the volume, an equalizer preset, loudness normalization and
+    a soft limiter to the frames of a PCM source.
+
+    A replacement for PCMVolumeTransformer working on NumPy views of
+    buffers allocated once, so no frame sized object is created per frame.
+    The frame returned by ``read`` is a ctypes view of the output buffer,
+    it's only valid until the next read.
+
+    The loudness is normalized to ``TARGET`` dBFS RMS, from ``track_gain``
+    when the loudness of the track is known and from a running estimate
+    of the frames played so far otherwise.
+    """
+    TARGET = -16.0
+    # Bounds of the normalization gain, in dB.
+    MAX_BOOST = 10.0
+    MAX_CUT = -20.0
+    # Seconds the running loudness estimate averages over.
+    WINDOW = 3.0
+    # Frames quieter than this (dBFS RMS) don't count towards the estimate.
+    GATE = -60.0
+    # Samples above this level are softly compressed towards full scale.
+    THRESHOLD = 0.8
+
+    def __init__(self,
+                 original: discord.AudioSource,
+                 volume: float = 1.0,
+                 *,
+                 eq: str = 'flat',
+                 normalize: bool = True):
+        if original.is_opus():
+            raise discord.ClientException(
+                'AudioSource must not be Opus encoded.')
+
+        self.original = original
+        self.volume = volume
+        self.normalize = normalize
+        # Gain in dB bringing the track to TARGET, set once it's measured.
+        self.track_gain: typing.Optional[float] = None
+
+        self._eq: typing.Optional[Equalizer] = None
+        self._preset = 'flat'
+        self.eq = eq
+
+        shape = (SAMPLES_PER_FRAME, CHANNELS)
+        self._x = numpy.zeros(shape)
+        self._a = numpy.zeros(shape)
+        self._flat = self._a.reshape(-1)
+        self._b = numpy.zeros(shape)
+        self._gains = numpy.zeros(SAMPLES_PER_FRAME)
+        self._ramp = numpy.linspace(1 / SAMPLES_PER_FRAME, 1.0,
+                                    SAMPLES_PER_FRAME)
+        # Broadcasting the gains over both channels would take a temporary
+        # buffer, they are applied a channel at a time instead.
+        self._channels = [self._x[:, i] for i in range(CHANNELS)]
+        self._pcm = numpy.zeros(shape, dtype=numpy.int16)
+        self._frame = (ctypes.c_char * FRAME_SIZE).from_buffer(self._pcm)
+
+        self._gain: typing.Optional[float] = None
+        self._decay = 1 - discord.opus.Encoder.FRAME_LENGTH / 1000 / self.WINDOW
+        self._power = 0.0
+        self._weight = 0.0
+
+        self.limited = 0
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = max(value, 0.0)
+
+    @property
+    def eq(self) -> str:
+        return self._preset
+
+    @eq.setter
+    def eq(self, preset: str):
+        bands = EQ_PRESETS[preset]
+        # Swapped in whole, the player thread never sees a half built one.
+        self._eq = Equalizer(bands) if bands else None
+        self._preset = preset
+
+    @property
+    def loudness(self) -> typing.Optional[float]:
+        """The running loudness estimate in dBFS RMS, if any."""
+        if not self._weight:
+            return None
+        return 10 * math.log10(max(self._power / self._weight, 1e-12))
+
+    @property
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        loudness = self.loudness
+        return {
+            'eq': self._preset,
+            'loudness_db': None if loudness is None else round(loudness, 1),
+            'track_gain_db': self.track_gain,
+            'gain_db': round(self._db(self._normalization()), 1),
+            'limited': self.limited,
+        }
+
+    @staticmethod
+    def _db(gain: float) -> float:
+        return 20 * math.log10(max(gain, 1e-6))
+
+    def _measure(self) -> None:
+        flat = self._x.reshape(-1)
+        power = float(numpy.dot(flat, flat)) / flat.size
+        if power > 10**(self.GATE / 10):
+            self._power = self._power * self._decay + power
+            self._weight = self._weight * self._decay + 1
+
+    def _normalization(self) -> float:
+        if self.track_gain is not None:
+            gain = self.track_gain
+        elif self.normalize and self._weight:
+            gain = self.TARGET - self.loudness
+        else:
+            return 1.0
+        return 10**(min(self.MAX_BOOST, max(self.MAX_CUT, gain)) / 20)
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if len(data) != FRAME_SIZE:
+            return b''
+
+        x = self._x
+        pcm = numpy.frombuffer(data, dtype=numpy.int16).reshape(x.shape)
+        # Cast first, a mixed type multiply would allocate a cast buffer.
+        numpy.copyto(x, pcm)
+        numpy.multiply(x, 1 / 32768, out=x)
+
+        if self.normalize and self.track_gain is None:
+            self._measure()
+
+        if self._eq is not None:
+            self._eq.process(x)
+
+        # Gain changes are ramped over the frame so they don't click.
+        gain = self._volume * self._normalization()
+        previous = gain if self._gain is None else self._gain
+        self._gain = gain
+        if gain == previous:
+            numpy.multiply(x, gain, out=x)
+        else:
+            numpy.multiply(self._ramp, gain - previous, out=self._gains)
+            numpy.add(self._gains, previous, out=self._gains)
+            for channel in self._channels:
+                numpy.multiply(channel, self._gains, out=channel)
+
+        self._limit(x)
+
+        numpy.multiply(x, 32767, out=self._a)
+        numpy.rint(self._a, out=self._a)
+        numpy.copyto(self._pcm, self._a, casting='unsafe')
+        return self._frame
+
+    def _limit(self, x: numpy.ndarray) -> None:
+        # Above the threshold, the excess e becomes k * tanh(e / k) with k
+        # the headroom left, so peaks bend towards full scale instead of
+        # wrapping around.
+        excess, bent = self._a, self._b
+        numpy.abs(x, out=excess)
+        numpy.subtract(excess, self.THRESHOLD, out=excess)
+        numpy.maximum(excess, 0.0, out=excess)
+        # A dot product is the cheapest way to ask for any excess, max()
+        # and any() allocate a kilobyte of reduction state.
+        if not numpy.dot(self._flat, self._flat):
+            return
+
+        self.limited += 1
+        headroom = 1.0 - self.THRESHOLD
+        numpy.multiply(excess, 1 / headroom, out=bent)
+        numpy.tanh(bent, out=bent)
+        numpy.multiply(bent, headroom, out=bent)
+        numpy.subtract(excess, bent, out=excess)
+        numpy.copysign(excess, x, out=excess)
+        numpy.subtract(x, excess, out=x)
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        self.original.cleanup()
+
+
+class CrossfadeSource(discord.AudioSource):
+    """Plays a PCM source and fades it into the next one over its last
+    ``length`` seconds.
+
+    ``upcoming`` is called once the fade is due and returns the next
+    source, if it's ready. The fade is skipped when it isn't. Frames of
+    the next source mixed in are read from it, so it goes on from the end
+    of the fade when it's played next. Curves are equal power, the gains
+    of both sources add up to a constant power over the fade.
+
+    ``source`` must have ``position`` and ``track`` like YTDLSource, the
+    end of the song is found from the duration of its track. A seek during
+    the fade starts it over from the new position, with whatever source
+    ``upcoming`` returns by then.
+    """
+    def __init__(self, source: discord.AudioSource, length: float,
+                 upcoming: typing.Callable[[],
+                                           typing.Optional[discord.AudioSource]]):
+        self.source = source
+        self.length = length
+        self.upcoming = upcoming
+
+        self._next: typing.Optional[discord.AudioSource] = None
+        # What was left of the song at the last frame read while fading,
+        # seeks are told apart from playback by it.
+        self._left = 0.0
+        self._frames = 0
+        self._frame = 0
+        self._ended = False
+
+        # Interleaved samples, flat and single precision: mixing is a
+        # handful of whole frame operations.
+        size = SAMPLES_PER_FRAME * CHANNELS
+        self._out = numpy.zeros(size, dtype=numpy.float32)
+        self._in = numpy.zeros(size, dtype=numpy.float32)
+        self._phases = numpy.zeros(size, dtype=numpy.float32)
+        self._fade_out = numpy.zeros(size, dtype=numpy.float32)
+        self._fade_in = numpy.zeros(size, dtype=numpy.float32)
+        self._pcm = numpy.zeros(size, dtype=numpy.int16)
+        self._frame_view = (ctypes.c_char * FRAME_SIZE).from_buffer(self._pcm)
+
+        self.fades = 0
+
+    @property
+    def fading(self) -> bool:
+        return self._next is not None
+
+    def _remaining(self) -> typing.Optional[float]:
+        duration = self.source.track.duration
+        if not duration:
+            return None
+        return duration - self.source.position
+
+    def _start(self) -> bool:
+        remaining = self._remaining()
+        if remaining is None or remaining > self.length:
+            return False
+
+        upcoming = self.upcoming()
+        if upcoming is None or upcoming.is_opus():
+            return False
+
+        self._next = upcoming
+        self._left = remaining
+        self._frames = max(1, int(remaining * SAMPLE_RATE) // SAMPLES_PER_FRAME)
+        self._frame = 0
+        # The phase of the curves over a frame, from 0 to pi / 2 over the
+        # whole fade, both channels of a sample sharing it.
+        self._step = math.pi / 2 / self._frames
+        self._base = (numpy.repeat(numpy.arange(SAMPLES_PER_FRAME), CHANNELS) *
+                      (self._step / SAMPLES_PER_FRAME)).astype(numpy.float32)
+        self.fades += 1
+        return True
+
+    def _seeked(self) -> bool:
+        if self.upcoming() is not self._next:
+            return True
+        remaining, expected = self._remaining(), self._left - FRAME_LENGTH
+        self._left = remaining
+        return (remaining > self.length
+                or abs(remaining - expected) > FRAME_LENGTH)
+
+    def read(self) -> bytes:
+        if self._ended:
+            return b''
+
+        data = self.source.read()
+        if not data:
+            return b''
+
+        if self._next is not None and self._seeked():
+            # The player discards the next source on seeks and opens it
+            # again, the fade starts over from where the song is now.
+            self._next = None
+        if self._next is None and not self._start():
+            return data
+
+        if self._frame >= self._frames:
+            # Faded out, what's left of the song isn't heard anyway.
+            self._ended = True
+            return b''
+
+        ready = getattr(self._next, 'ready', None)
+        if ready is not None and not ready():
+            # Mixed in from the next frame on, rather than waited for.
+            return data
+
+        incoming = self._next.read()
+        if not incoming:
+            return data
+
+        numpy.add(self._base, self._frame * self._step, out=self._phases)
+        numpy.cos(self._phases, out=self._fade_out)
+        numpy.sin(self._phases, out=self._fade_in)
+        self._frame += 1
+
+        numpy.copyto(self._out, numpy.frombuffer(data, dtype=numpy.int16))
+        numpy.copyto(self._in, numpy.frombuffer(incoming, dtype=numpy.int16))
+        numpy.multiply(self._out, self._fade_out, out=self._out)
+        numpy.multiply(self._in, self._fade_in, out=self._in)
+        numpy.add(self._out, self._in, out=self._out)
+        # Correlated songs can add up over full scale.
+        numpy.clip(self._out, -32768, 32767, out=self._out)
+        numpy.copyto(self._pcm, self._out, casting='unsafe')
+        return self._frame_view
+
+    def ready(self) -> bool:
+        if self._ended:
+            return True
+        ready = getattr(self.source, 'ready', None)
+        return ready is None or ready()
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        # The next source is played on its own once this one is done.
+        self.source.cleanup()
+
+
+def transform(original: discord.AudioSource,
+              volume: float,
+              *,
+              eq: str = 'flat',
+              gain: typing.Optional[float] = None) -> discord.AudioSource:
+    """Wraps a PCM source in a DSPAudioSource, or in PCMVolumeTransformer
+    (volume and track gain only) when NumPy isn't installed.
+    """
+    if numpy is None:
+        if gain is not None:
+            volume *= 10**(gain / 20)
+        return discord.PCMVolumeTransformer(original, volume)
+
+    source = DSPAudioSource(original, volume, eq=eq)
+    source.track_gain = gain
+    return source
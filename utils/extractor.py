@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import asyncio, collections, multiprocessing, os, threading, time, typing
+
+import youtube_dl
+
+from utils.cache import slim_info
+
+__all__ = ('ExtractionPool', 'ExtractionError')
+
+
+class ExtractionError(Exception):
+    pass
+
+
+# Each worker process owns its YoutubeDL instances, set up by _init_worker.
+_ytdl = None
+_playlist_ytdl = None
+
+
+def _init_worker(options: dict) -> None:
+    global _ytdl, _playlist_ytdl
+    youtube_dl.utils.bug_reports_message = lambda: ''
+    _ytdl = youtube_dl.YoutubeDL(options)
+    _playlist_ytdl = youtube_dl.YoutubeDL(
+        dict(options, noplaylist=False, extract_flat='in_playlist'))
+
+
+def _extract(url: str,
+             *,
+             ytdl: youtube_dl.YoutubeDL = None,
+             **kwargs) -> typing.Optional[dict]:
+    try:
+        return (ytdl or _ytdl).extract_info(url, download=False, **kwargs)
+    except Exception as e:
+        # youtube_dl errors carry tracebacks, which can't be pickled.
+        raise ExtractionError(str(e)) from None
+
+
+def _probe(search: str) -> typing.Optional[str]:
+    """Resolves a query to the webpage URL of its first match."""
+    data = _extract(search, process=False)
+    if data is None:
+        return None
+
+    if 'entries' not in data:
+        return data['webpage_url']
+
+    for entry in data['entries']:
+        if entry:
+            return entry['webpage_url']
+
+    return None
+
+
+def _process(webpage_url: str) -> typing.Optional[dict]:
+    """Fully extracts a webpage URL, only the slim info leaves the worker."""
+    info = _extract(webpage_url)
+    if info is None:
+        return None
+
+    if 'entries' in info:
+        info = next((entry for entry in info['entries'] if entry), None)
+        if info is None:
+            return None
+
+    return slim_info(info)
+
+
+def _serve(conn, options: dict) -> None:
+    """Runs the jobs sent by an ExtractionPool, one at a time."""
+    _init_worker(options)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        func, args = job
+        try:
+            result = (True, func(*args))
+        except ExtractionError as e:
+            result = (False, str(e))
+        except Exception as e:
+            result = (False, '{}: {}'.format(type(e).__name__, e))
+        conn.send(result)
+
+
+def _flat_entry(entry: dict) -> typing.Optional[dict]:
+    urls = (entry.get('webpage_url'), entry.get('url'))
+    url = next((url for url in urls if url and '://' in url), None)
+    if url is None:
+        # Only YouTube's bare ids can be turned into a URL, entries of other
+        # sites can't be played without one.
+        video_id = entry.get('url') or entry.get('id')
+        if not video_id or entry.get('ie_key') != 'Youtube':
+            return None
+        url = 'https://www.youtube.com/watch?v=' + video_id
+
+    return {
+        'id': entry.get('id'),
+        'title': entry.get('title'),
+        'uploader': entry.get('uploader'),
+        'duration': entry.get('duration'),
+        'webpage_url': url,
+    }
+
+
+def _playlist(url: str, start: int, end: int) -> typing.Optional[list]:
+    """Lists entries ``start`` to ``end`` (1-based) of a playlist without
+    resolving them. A plain video comes back fully extracted.
+    """
+    _playlist_ytdl.params.update(playliststart=start, playlistend=end)
+    info = _extract(url, ytdl=_playlist_ytdl)
+    if info is None:
+        return None
+
+    if 'entries' not in info:
+        return [slim_info(info)] if start == 1 else []
+
+    entries = (_flat_entry(entry) for entry in info['entries'] if entry)
+    return [entry for entry in entries if entry]
+
+
+class _Worker:
+    """A worker process of an ExtractionPool and its end of the pipe."""
+    def __init__(self, context, options: dict):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve,
+                                       args=(child, options),
+                                       name='extractor',
+                                       daemon=True)
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    async def wait(self, timeout: float) -> bool:
+        """Waits for the result of the job on the event loop, without
+        holding a thread. A worker that died counts as done, recv says so.
+        """
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+        return True
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.conn.close()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.conn.close()
+        # Reaped on another thread, the event loop doesn't wait for it.
+        threading.Thread(target=self.process.join,
+                         name='extractor-reaper',
+                         daemon=True).start()
+
+
+class ExtractionPool:
+    """A bounded pool of worker processes running youtube_dl.
+
+    Keeps youtube_dl's parsing off the bot process and its GIL. A worker
+    runs one job at a time, and is replaced with a fresh one after
+    ``recycle_after`` jobs so that leaks in the workers can't accumulate.
+
+    A job times out ``timeout`` seconds after a worker has started running
+    it, time spent waiting for a free worker doesn't count. The worker of a
+    job that timed out is killed, the others carry on. At most
+    ``max_pending`` jobs are running or waiting, more are rejected.
+    """
+    def __init__(self,
+                 options: dict,
+                 *,
+                 max_workers: typing.Optional[int] = None,
+                 timeout: float = 30.0,
+                 recycle_after: int = 100,
+                 max_pending: int = 100):
+        self.options = options
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.timeout = timeout
+        self.recycle_after = recycle_after
+        self.max_pending = max_pending
+
+        self._context = multiprocessing.get_context('spawn')
+        self._idle: typing.List[_Worker] = []
+        self._busy: typing.Set[_Worker] = set()
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+        self._latencies = collections.deque(maxlen=256)
+
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.recycled = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        latencies = sorted(self._latencies)
+        return {
+            'workers': self.max_workers,
+            'pending': self.pending,
+            'queued': max(0, self.pending - self.max_workers),
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'recycled': self.recycled,
+            'latency_avg':
+            round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            'latency_max': round(latencies[-1], 3) if latencies else 0.0,
+        }
+
+    async def run(self, func: typing.Callable, *args) -> typing.Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise ExtractionError(
+                'Too many lookups are waiting, please try again in a moment.')
+
+        start = time.perf_counter()
+        self.pending += 1
+        # A caller going away doesn't interrupt the worker, the job runs to
+        # its end so that the worker can be reused.
+        job = asyncio.ensure_future(self._execute(func, args))
+        try:
+            result = await asyncio.shield(job)
+        except ExtractionError:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            return result
+        finally:
+            if job.done():
+                self.pending -= 1
+                self._latencies.append(time.perf_counter() - start)
+            else:
+                job.add_done_callback(self._abandoned)
+
+    def _abandoned(self, job: asyncio.Future) -> None:
+        self.pending -= 1
+        if not job.cancelled():
+            job.exception()
+
+    async def _execute(self, func: typing.Callable, args: tuple) -> typing.Any:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+
+        async with self._semaphore:
+            worker = self._idle.pop() if self._idle else _Worker(
+                self._context, self.options)
+            self._busy.add(worker)
+            try:
+                worker.conn.send((func, args))
+                worker.jobs += 1
+                finished = await worker.wait(self.timeout)
+                if not finished:
+                    self.timeouts += 1
+                    # The stuck worker can't be interrupted, only killed.
+                    worker.kill()
+                    raise ExtractionError(
+                        'Timed out after {} seconds'.format(self.timeout))
+
+                try:
+                    ok, result = worker.conn.recv()
+                except (EOFError, OSError):
+                    worker.kill()
+                    raise ExtractionError('The extraction worker died') from None
+            except BaseException:
+                self._busy.discard(worker)
+                if not worker.conn.closed:
+                    worker.kill()
+                raise
+
+            self._busy.discard(worker)
+            if worker.jobs >= self.recycle_after:
+                worker.stop()
+                self.recycled += 1
+            else:
+                self._idle.append(worker)
+
+        if not ok:
+            raise ExtractionError(result)
+        return result
+
+    async def probe(self, search: str) -> typing.Optional[str]:
+        return await self.run(_probe, search)
+
+    async def process(self, webpage_url: str) -> typing.Optional[dict]:
+        return await self.run(_process, webpage_url)
+
+    async def playlist(self, url: str, start: int,
+                       end: int) -> typing.Optional[list]:
+        return await self.run(_playlist, url, start, end)
+
+    def shutdown(self) -> None:
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+        for worker in list(self._busy):
+            worker.kill()
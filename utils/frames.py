@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import ctypes, typing
+
+import discord
+
+__all__ = ('FramePool', 'PooledPCMAudio')
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+
+
+class FramePool:
+    """Frame sized buffers, recycled instead of allocated for every frame.
+
+    A frame is a ctypes char array: it can be filled with ``readinto``,
+    read by NumPy or audioop through the buffer protocol, and passed to the
+    Opus encoder as it is, which only takes bytes or ctypes objects. Frames
+    are acquired and released from different threads, list appends and
+    pops are atomic. At most ``max_free`` released frames are kept.
+    """
+    def __init__(self, size: int = FRAME_SIZE, *, max_free: int = 4096):
+        self.size = size
+        self.max_free = max_free
+        self._type = ctypes.c_char * size
+        self._free: typing.List[ctypes.Array] = []
+
+        self.allocated = 0
+        self.reused = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'allocated': self.allocated,
+            'reused': self.reused,
+            'free': len(self._free),
+        }
+
+    def acquire(self) -> ctypes.Array:
+        try:
+            frame = self._free.pop()
+        except IndexError:
+            self.allocated += 1
+            return self._type()
+
+        self.reused += 1
+        return frame
+
+    def release(self, frame: ctypes.Array) -> None:
+        if len(self._free) < self.max_free:
+            self._free.append(frame)
+
+
+class PooledPCMAudio(discord.FFmpegPCMAudio):
+    """FFmpegPCMAudio reading frames into buffers of a FramePool.
+
+    A frame returned by ``read`` must be given back with ``release`` once
+    it has been used, BufferedAudioSource does so when the next frame is
+    read from it.
+    """
+    def __init__(self, source: str, *, pool: FramePool, **kwargs):
+        super().__init__(source, **kwargs)
+        self.pool = pool
+
+    def read(self) -> bytes:
+        frame = self.pool.acquire()
+        if self._stdout.readinto(frame) != FRAME_SIZE:
+            self.pool.release(frame)
+            return b''
+        return frame
+
+    def release(self, frame: ctypes.Array) -> None:
+        self.pool.release(frame)
@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import itertools, random, typing
+
+__all__ = ('IndexedList', )
+
+T = typing.TypeVar('T')
+
+
+class IndexedList(typing.Generic[T]):
+    """A list that stays fast at any position.
+
+    Items are kept in chunks of about ``LOAD`` items, and a Fenwick tree
+    over the chunk lengths finds the chunk holding an index in O(log n).
+    Indexing, insert, remove and move then cost O(log n) plus a memmove
+    inside one chunk, the length is O(1).
+    """
+    LOAD = 256
+
+    def __init__(self, iterable: typing.Iterable[T] = ()):
+        self._chunks: typing.List[typing.List[T]] = []
+        self._tree: typing.List[int] = [0]
+        self._len = 0
+        self.extend(iterable)
+
+    def __repr__(self):
+        return '{0.__class__.__name__}({1!r})'.format(self, list(self))
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __iter__(self) -> typing.Iterator[T]:
+        return itertools.chain.from_iterable(self._chunks)
+
+    def __reversed__(self) -> typing.Iterator[T]:
+        for chunk in reversed(self._chunks):
+            yield from reversed(chunk)
+
+    # Fenwick tree over the chunk lengths, 1-based.
+
+    def _rebuild(self) -> None:
+        tree = [0] * (len(self._chunks) + 1)
+        for i, chunk in enumerate(self._chunks, start=1):
+            tree[i] += len(chunk)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, chunk: int, delta: int) -> None:
+        i = chunk + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _locate(self, index: int) -> typing.Tuple[int, int]:
+        """Returns the chunk holding ``index`` and the offset within it."""
+        pos = 0
+        step = 1 << len(self._chunks).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= index:
+                pos = nxt
+                index -= self._tree[nxt]
+            step >>= 1
+        return pos, index
+
+    def _index(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('list index out of range')
+        return index
+
+    def _split(self, chunk: int) -> None:
+        items = self._chunks[chunk]
+        if len(items) > 2 * self.LOAD:
+            half = len(items) // 2
+            self._chunks[chunk:chunk + 1] = [items[:half], items[half:]]
+            self._rebuild()
+
+    def _shrunk(self, chunk: int) -> None:
+        if not self._chunks[chunk]:
+            del self._chunks[chunk]
+            self._rebuild()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+            return self._range(start, stop)
+
+        chunk, offset = self._locate(self._index(index))
+        return self._chunks[chunk][offset]
+
+    def _range(self, start: int, stop: int) -> typing.List[T]:
+        if start >= stop:
+            return []
+
+        chunk, offset = self._locate(start)
+        items = []
+        remaining = stop - start
+        while remaining > 0:
+            part = self._chunks[chunk][offset:offset + remaining]
+            items.extend(part)
+            remaining -= len(part)
+            chunk += 1
+            offset = 0
+        return items
+
+    def __setitem__(self, index: int, value: T) -> None:
+        chunk, offset = self._locate(self._index(index))
+        self._chunks[chunk][offset] = value
+
+    def __delitem__(self, index) -> None:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                items = list(self)
+                del items[index]
+                self.clear()
+                self.extend(items)
+            else:
+                self.delete_range(start, stop)
+            return
+
+        self.pop(index)
+
+    def append(self, value: T) -> None:
+        if not self._chunks:
+            self._chunks.append([value])
+            self._rebuild()
+        else:
+            last = len(self._chunks) - 1
+            self._chunks[last].append(value)
+            self._add(last, 1)
+            self._split(last)
+        self._len += 1
+
+    def extend(self, iterable: typing.Iterable[T]) -> None:
+        items = list(iterable)
+        if not items:
+            return
+
+        self._len += len(items)
+        if self._chunks and len(self._chunks[-1]) < self.LOAD:
+            room = self.LOAD - len(self._chunks[-1])
+            self._chunks[-1].extend(items[:room])
+            items = items[room:]
+
+        for i in range(0, len(items), self.LOAD):
+            self._chunks.append(items[i:i + self.LOAD])
+        self._rebuild()
+
+    def insert(self, index: int, value: T) -> None:
+        if index < 0:
+            index = max(0, index + self._len)
+        if index >= self._len:
+            return self.append(value)
+
+        chunk, offset = self._locate(index)
+        self._chunks[chunk].insert(offset, value)
+        self._add(chunk, 1)
+        self._len += 1
+        self._split(chunk)
+
+    def pop(self, index: int = -1) -> T:
+        chunk, offset = self._locate(self._index(index))
+        value = self._chunks[chunk].pop(offset)
+        self._add(chunk, -1)
+        self._len -= 1
+        self._shrunk(chunk)
+        return value
+
+    def popleft(self) -> T:
+        return self.pop(0)
+
+    def remove(self, value: T) -> None:
+        for index, item in enumerate(self):
+            if item == value:
+                del self[index]
+                return
+        raise ValueError('{!r} is not in list'.format(value))
+
+    def move(self, source: int, destination: int) -> None:
+        """Moves the item at ``source`` so that it ends up at ``destination``."""
+        destination = self._index(destination)
+        self.insert(destination, self.pop(source))
+
+    def delete_range(self, start: int, stop: int) -> None:
+        """Deletes the items from ``start`` up to, not including, ``stop``."""
+        start = max(0, start)
+        stop = min(self._len, stop)
+        if start >= stop:
+            return
+
+        first, offset = self._locate(start)
+        chunk = first
+        remaining = stop - start
+        while remaining > 0:
+            items = self._chunks[chunk]
+            count = min(remaining, len(items) - offset)
+            del items[offset:offset + count]
+            self._add(chunk, -count)
+            remaining -= count
+            chunk += 1
+            offset = 0
+
+        self._len -= stop - start
+        emptied = [i for i in range(first, chunk) if not self._chunks[i]]
+        if emptied:
+            self._chunks[first:chunk] = [
+                items for items in self._chunks[first:chunk] if items
+            ]
+            self._rebuild()
+
+    def clear(self) -> None:
+        self._chunks = []
+        self._tree = [0]
+        self._len = 0
+
+    def shuffle(self) -> None:
+        items = list(self)
+        random.shuffle(items)
+        self.clear()
+        self.extend(items)
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import asyncio, math, re, subprocess, typing
+
+from utils.cache import normalize_query
+from utils.track import Track
+from utils.trackstore import TrackStore
+
+__all__ = ('LoudnessAnalyzer', 'loudnorm_filter', 'track_gain', 'track_level')
+
+# Integrated loudness tracks are brought to, in LUFS. About the level the
+# running estimate of utils/dsp.py aims at.
+TARGET = -16.0
+# The gain never pushes the true peak of a track above this, in dBTP.
+MAX_PEAK = -1.0
+MAX_BOOST = 10.0
+MAX_CUT = -20.0
+
+_INTEGRATED = re.compile(r'^\s*I:\s+(-?[\d.]+) LUFS', re.MULTILINE)
+_PEAK = re.compile(r'^\s*Peak:\s+(-?[\d.]+|-inf) dBFS', re.MULTILINE)
+
+
+def track_gain(track: Track) -> typing.Optional[float]:
+    """The gain in dB bringing an analyzed track to the target loudness,
+    ``None`` if the track hasn't been analyzed.
+    """
+    if track.loudness is None:
+        return None
+
+    gain = TARGET - track.loudness
+    if track.peak is not None:
+        gain = min(gain, MAX_PEAK - track.peak)
+    return min(MAX_BOOST, max(MAX_CUT, gain))
+
+
+def track_level(track: Track, volume: float) -> float:
+    """``volume`` with the gain of ``track`` applied."""
+    gain = track_gain(track)
+    return volume if gain is None else volume * 10**(gain / 20)
+
+
+def loudnorm_filter() -> str:
+    """FFmpeg's loudnorm filter aiming at the same target, for tracks played
+    before they're analyzed. In a single pass it follows a running estimate
+    of the loudness, like the DSP stage does in Python.
+    """
+    return 'loudnorm=I={}:TP={}'.format(TARGET, MAX_PEAK)
+
+
+class LoudnessAnalyzer:
+    """Measures the integrated loudness and true peak of tracks once, with
+    FFmpeg's ebur128 filter, and keeps them with the track info of a
+    TrackStore.
+
+    At most ``concurrency`` analyses run at once, tracks asked for while
+    ``max_pending`` are waiting are left for a later play.
+    """
+    def __init__(self,
+                 store: TrackStore,
+                 *,
+                 concurrency: int = 2,
+                 max_pending: int = 50,
+                 max_duration: int = 20 * 60,
+                 executable: str = 'ffmpeg'):
+        self.store = store
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.max_duration = max_duration
+        self.executable = executable
+
+        self._measured: OrderedDict[str, typing.Tuple[
+            float, typing.Optional[float]]] = OrderedDict()
+        self._running: typing.Dict[str, asyncio.Task] = {}
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+
+        self.analyses = 0
+        self.failures = 0
+        self.dropped = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'known': len(self._measured),
+            'pending': len(self._running),
+            'analyses': self.analyses,
+            'failures': self.failures,
+            'dropped': self.dropped,
+        }
+
+    def _remember(self, key: str,
+                  measured: typing.Tuple[float, typing.Optional[float]]) -> None:
+        self._measured[key] = measured
+        self._measured.move_to_end(key)
+        while len(self._measured) > 10000:
+            self._measured.popitem(last=False)
+
+    async def resolve(self, track: Track) -> Track:
+        """Returns ``track`` with its loudness, if it has been measured."""
+        if track.loudness is not None:
+            return track
+
+        key = normalize_query(track.webpage_url)
+        measured = self._measured.get(key)
+        if measured is None:
+            measured = await self.store.get_loudness(track.webpage_url)
+            if measured is not None:
+                self._remember(key, measured)
+
+        if measured is not None:
+            return track.replace(loudness=measured[0], peak=measured[1])
+        return track
+
+    def analyze(self, track: Track, source: typing.Optional[str]) -> None:
+        """Starts measuring ``source``, a file or the stream URL of
+        ``track``, in the background.
+        """
+        key = normalize_query(track.webpage_url)
+        if (not source or key in self._running or key in self._measured
+                or not track.duration or track.duration > self.max_duration):
+            return
+
+        if len(self._running) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        task = asyncio.ensure_future(self._analyze(key, track, source))
+        self._running[key] = task
+        task.add_done_callback(lambda _: self._running.pop(key, None))
+
+    async def _analyze(self, key: str, track: Track, source: str) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            measured = await self._measure(source)
+
+        if measured is None:
+            self.failures += 1
+            return
+
+        self.analyses += 1
+        self._remember(key, measured)
+        self.store.put(None,
+                       track.replace(loudness=measured[0], peak=measured[1]))
+
+    async def _measure(
+        self, source: str
+    ) -> typing.Optional[typing.Tuple[float, typing.Optional[float]]]:
+        options = ()
+        if source.startswith(('http://', 'https://')):
+            options = ('-reconnect', '1', '-reconnect_streamed', '1',
+                       '-reconnect_delay_max', '5')
+
+        process = await asyncio.create_subprocess_exec(
+            self.executable, '-nostdin', '-hide_banner', '-nostats', *options,
+            '-i', source, '-vn', '-af', 'ebur128=peak=true:framelog=verbose', '-f', 'null',
+            '-',
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+        if process.returncode != 0:
+            return None
+
+        # The summary is printed last, after the per frame log lines.
+        output = stderr.decode(errors='replace')
+        integrated = _INTEGRATED.findall(output)
+        if not integrated:
+            return None
+
+        peaks = _PEAK.findall(output)
+        peak = float(peaks[-1]) if peaks else None
+        if peak is not None and not math.isfinite(peak):
+            peak = None
+        return float(integrated[-1]), peak
+
+    def close(self) -> None:
+        for task in list(self._running.values()):
+            task.cancel()
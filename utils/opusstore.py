@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import asyncio, mmap, os, struct, subprocess, time, typing
+
+import discord
+from discord.oggparse import OggStream
+
+from utils.audio import FRAME_LENGTH
+from utils.audiocache import AudioCache
+
+__all__ = ('OpusFrameStore', 'MmapOpusSource')
+
+# Container layout: this header, ``count + 1`` little endian uint32 packet
+# offsets from the start of the file, then the packets back to back.
+HEADER = struct.Struct('<4sHHI')
+MAGIC = b'OPFS'
+VERSION = 1
+OFFSET = struct.Struct('<II')
+
+
+def _convert(ogg_path: str, path: str) -> int:
+    """Writes the Opus packets of an Ogg file to a frame store container,
+    returns its size.
+    """
+    with open(ogg_path, 'rb') as f:
+        packets = [
+            packet for packet in OggStream(f).iter_packets()
+            if not packet.startswith((b'OpusHead', b'OpusTags'))
+        ]
+
+    offset = HEADER.size + 4 * (len(packets) + 1)
+    offsets = [offset]
+    for packet in packets:
+        offset += len(packet)
+        offsets.append(offset)
+
+    partial = path + '.part'
+    with open(partial, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(packets)))
+        f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+        f.writelines(packets)
+    os.replace(partial, path)
+    return offset
+
+
+class MmapOpusSource(discord.AudioSource):
+    """Plays the packets of a frame store container as they are.
+
+    The file is memory mapped, a frame is a slice of it, and seeking is an
+    index lookup.
+    """
+    def __init__(self, path: str, *, start: float = 0.0):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError('{} is not a frame store file'.format(path))
+
+        self.frame = 0
+        self.underruns = 0
+        self.seek(start)
+
+    @property
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'fill': self.count - self.frame,
+            'target': 0,
+            'underruns': 0,
+        }
+
+    def seek(self, position: float) -> None:
+        self.frame = min(self.count, max(0, int(position / FRAME_LENGTH)))
+
+    def read(self) -> bytes:
+        if self.frame >= self.count or self._map.closed:
+            return b''
+
+        start, end = OFFSET.unpack_from(self._map,
+                                        HEADER.size + 4 * self.frame)
+        self.frame += 1
+        return self._map[start:end]
+
+    def ready(self) -> bool:
+        return True
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self._map.close()
+
+
+class _StoredFrames:
+    __slots__ = ('path', 'size', 'last_used')
+
+    def __init__(self, path: str, size: int, last_used: float):
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+
+
+class OpusFrameStore:
+    """The encoded Opus frames of popular tracks, ready to be sent.
+
+    Built from the files of the AudioCache, once per track and volume,
+    since the volume of Opus frames can't be changed without decoding them.
+    At unity volume the packets are copied over as they are, other volumes
+    are encoded once more by FFmpeg. The least recently used files go
+    first when the store grows over ``max_bytes``.
+    """
+    EXTENSION = '.opf'
+
+    def __init__(self,
+                 directory: str,
+                 *,
+                 max_bytes: int = 1024**3,
+                 concurrency: int = 1,
+                 bitrate: int = 128,
+                 executable: str = 'ffmpeg'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.bitrate = bitrate
+        self.executable = executable
+
+        self._files: typing.Dict[str, _StoredFrames] = {}
+        self._building: typing.Dict[str, asyncio.Task] = {}
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+        self._bytes = 0
+        self._loaded = False
+
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.evictions = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'files': len(self._files),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'building': len(self._building),
+            'builds': self.builds,
+            'evictions': self.evictions,
+        }
+
+    @staticmethod
+    def key(webpage_url: str, volume: float) -> str:
+        return '{}-{:.2f}'.format(AudioCache.key(webpage_url), volume)
+
+    def _load(self) -> None:
+        self._loaded = True
+        if not os.path.isdir(self.directory):
+            return
+
+        for entry in os.scandir(self.directory):
+            key, ext = os.path.splitext(entry.name)
+            if ext == self.EXTENSION:
+                stat = entry.stat()
+                self._files[key] = _StoredFrames(entry.path, stat.st_size,
+                                                 stat.st_mtime)
+                self._bytes += stat.st_size
+            else:
+                # Leftovers of a build that was interrupted.
+                os.remove(entry.path)
+
+        self._evict()
+
+    def contains(self, webpage_url: str, volume: float) -> bool:
+        if not self._loaded:
+            self._load()
+        return self.key(webpage_url, volume) in self._files
+
+    def lookup(self, webpage_url: str, volume: float) -> typing.Optional[str]:
+        """Returns the path of the frames of a track at a volume, if any."""
+        if not self._loaded:
+            self._load()
+
+        stored = self._files.get(self.key(webpage_url, volume))
+        if stored is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        stored.last_used = time.time()
+        return stored.path
+
+    def add(self, webpage_url: str, volume: float, ogg_path: str) -> None:
+        """Builds the frames of a track from its audio cache file in the
+        background, unless they exist already.
+        """
+        key = self.key(webpage_url, volume)
+        if key in self._files or key in self._building:
+            return
+
+        task = asyncio.ensure_future(self._build(key, volume, ogg_path))
+        self._building[key] = task
+        task.add_done_callback(lambda _: self._building.pop(key, None))
+
+    async def _build(self, key: str, volume: float, ogg_path: str) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        path = os.path.join(self.directory, key + self.EXTENSION)
+        encoded = os.path.join(self.directory, key + '.ogg')
+
+        async with self._semaphore:
+            os.makedirs(self.directory, exist_ok=True)
+            source = ogg_path
+            if volume != 1.0:
+                process = await asyncio.create_subprocess_exec(
+                    self.executable, '-nostdin', '-loglevel', 'error', '-i',
+                    ogg_path, '-af', 'volume={:.2f}'.format(volume), '-c:a',
+                    'libopus', '-b:a', '{}k'.format(self.bitrate), '-f', 'ogg',
+                    '-y', encoded,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+                code = None
+                try:
+                    code = await process.wait()
+                except asyncio.CancelledError:
+                    process.kill()
+                    await process.wait()
+                    raise
+                finally:
+                    if code != 0 and os.path.exists(encoded):
+                        os.remove(encoded)
+                if code != 0:
+                    return
+                source = encoded
+
+            loop = asyncio.get_running_loop()
+            try:
+                size = await loop.run_in_executor(None, _convert, source, path)
+            except (OSError, discord.DiscordException):
+                # The cache file was evicted or cut short meanwhile.
+                return
+            finally:
+                if source == encoded:
+                    os.remove(encoded)
+
+        self._files[key] = _StoredFrames(path, size, time.time())
+        self._bytes += size
+        self.builds += 1
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._files:
+            key = min(self._files, key=lambda k: self._files[k].last_used)
+            stored = self._files.pop(key)
+            self._bytes -= stored.size
+            self.evictions += 1
+            try:
+                # Sources still playing the file keep it mapped.
+                os.remove(stored.path)
+            except FileNotFoundError:
+                pass
+
+    def close(self) -> None:
+        for task in list(self._building.values()):
+            task.cancel()
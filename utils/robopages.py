@@ -141,7 +141,7 @@ class RoboPages(discord.ui.View):
             await interaction.response.send_message(
                 f'An error occurred, sorry: {error}', ephemeral=True)
 
-    async def start(self) -> None:
+    async def start(self, *, page_number: int = 0) -> None:
         if self.check_embeds and not self.ctx.channel.permissions_for(
                 self.ctx.me).embed_links:
             await self.ctx.send(
@@ -149,9 +149,10 @@ class RoboPages(discord.ui.View):
             return
 
         await self.source._prepare_once()
-        page = await self.source.get_page(0)
+        page = await self.source.get_page(page_number)
+        self.current_page = page_number
         kwargs = await self._get_kwargs_from_page(page)
-        self._update_labels(0)
+        self._update_labels(page_number)
         self.message = await self.ctx.send(**kwargs, view=self)
 
     @discord.ui.button(label='≪', style=discord.ButtonStyle.grey)
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import asyncio, collections, functools, heapq, itertools, typing
+
+__all__ = ('FairScheduler', 'OrderedPipeline', 'AdmissionError')
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class FairScheduler:
+    """Runs coroutines with bounded concurrency, fairly across keys.
+
+    Waiting jobs are ordered by weighted fair queuing: every key gets a
+    virtual finish time that grows by ``1 / weight`` per job, so a key
+    submitting many jobs can't starve the others and keys with a higher
+    weight are served sooner. Jobs over the per key or global limit are
+    rejected with an ``AdmissionError``.
+    """
+    def __init__(self,
+                 *,
+                 concurrency: int = 4,
+                 per_key_limit: int = 5,
+                 global_limit: int = 100):
+        self.concurrency = concurrency
+        self.per_key_limit = per_key_limit
+        self.global_limit = global_limit
+
+        self._heap: typing.List[typing.Tuple[float, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._finish: typing.Dict[typing.Hashable, float] = {}
+        self._counts: typing.Counter[typing.Hashable] = collections.Counter()
+        self._running = 0
+        self._waiting = 0
+
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'running': self._running,
+            'waiting': self._waiting,
+            'keys': len(self._counts),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
+
+    def pending(self, key: typing.Hashable) -> int:
+        return self._counts.get(key, 0)
+
+    async def run(self,
+                  key: typing.Hashable,
+                  factory: typing.Callable[[], typing.Awaitable[typing.Any]],
+                  *,
+                  weight: float = 1.0) -> typing.Any:
+        if self._counts[key] >= self.per_key_limit:
+            self.rejected += 1
+            raise AdmissionError(
+                'Too many songs are being looked up for this server at once, '
+                'please wait for them to finish.')
+
+        if self._running + self._waiting >= self.global_limit:
+            self.rejected += 1
+            raise AdmissionError(
+                'The bot is too busy right now, please try again in a moment.')
+
+        self.admitted += 1
+        self._counts[key] += 1
+        try:
+            await self._acquire(key, weight)
+            try:
+                return await factory()
+            finally:
+                self._release()
+        finally:
+            self._counts[key] -= 1
+            if not self._counts[key]:
+                del self._counts[key]
+                if self._finish.get(key, 0.0) <= self._vtime:
+                    self._finish.pop(key, None)
+
+    async def _acquire(self, key: typing.Hashable, weight: float) -> None:
+        start = max(self._vtime, self._finish.get(key, 0.0))
+        finish = start + 1.0 / max(weight, 0.01)
+        self._finish[key] = finish
+
+        if self._running < self.concurrency and not self._heap:
+            self._vtime = finish
+            self._running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (finish, next(self._seq), future))
+        self._waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we got cancelled.
+                self._release()
+            raise
+        finally:
+            self._waiting -= 1
+
+    def _release(self) -> None:
+        self._running -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._running < self.concurrency and self._heap:
+            finish, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+
+            self._vtime = finish
+            self._running += 1
+            future.set_result(None)
+
+
+class OrderedPipeline:
+    """Runs jobs concurrently and commits their results in submission order.
+
+    At most ``concurrency`` jobs run at once. A result is handed to its
+    ``commit`` callback only after every job submitted before it has been
+    committed, has failed or has been cancelled, however fast it finished.
+    """
+    def __init__(self, concurrency: int = 3):
+        self.concurrency = concurrency
+
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+        self._submitted = 0
+        self._committed = 0
+        self._finished: typing.Dict[int, typing.Tuple[
+            typing.Optional[typing.Callable[[], typing.Any]],
+            typing.Optional[asyncio.Future]]] = {}
+
+    @property
+    def pending(self) -> int:
+        return self._submitted - self._committed
+
+    async def run(self, factory: typing.Callable[[],
+                                                 typing.Awaitable[typing.Any]],
+                  commit: typing.Callable[[typing.Any], typing.Any]) -> typing.Any:
+        """Runs ``factory()`` and returns its result once ``commit`` has been
+        called with it. A job that raises is skipped, the error is raised
+        right away.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        ticket = self._submitted
+        self._submitted += 1
+        try:
+            async with self._semaphore:
+                result = await factory()
+        except BaseException:
+            self._finish(ticket, None, None)
+            raise
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._finish(ticket, functools.partial(commit, result), waiter)
+        await waiter
+        return result
+
+    def _finish(self, ticket: int,
+                commit: typing.Optional[typing.Callable[[], typing.Any]],
+                waiter: typing.Optional[asyncio.Future]) -> None:
+        self._finished[ticket] = (commit, waiter)
+
+        while self._committed in self._finished:
+            commit, waiter = self._finished.pop(self._committed)
+            self._committed += 1
+            if commit is None:
+                continue
+
+            try:
+                commit()
+            except Exception as e:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            else:
+                if not waiter.done():
+                    waiter.set_result(None)
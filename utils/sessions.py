@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio, json, logging, sqlite3, time, typing
+
+__all__ = ('QueueUpdate', 'SessionStore')
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    guild_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    position REAL NOT NULL DEFAULT 0,
+    saved_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS songs (
+    guild_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (guild_id, seq)
+);
+'''
+
+
+class QueueUpdate(typing.NamedTuple):
+    """Changes to a stored queue. Songs before ``head`` are dropped and
+    ``entries``, ``(seq, song)`` pairs, are stored, the queue is its songs
+    in ``seq`` order. ``replace`` drops every stored song first.
+    """
+    head: int
+    entries: typing.List[typing.Tuple[int, dict]]
+    replace: bool
+
+
+class SessionStore:
+    """Snapshots of the players, kept in SQLite so that playback can be
+    resumed after a restart or a crash.
+
+    A snapshot is a ``state`` dict (channels, settings and the current
+    song), the playback ``position`` and the ``queue``, a QueueUpdate. The
+    queue is the expensive part, songs are stored one per row so that a
+    song starting or being queued only touches its own row. ``None`` leaves
+    the stored queue as it is. JSON encoding and all database work happen
+    on a single background thread.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='sessions')
+        self._conn: typing.Optional[sqlite3.Connection] = None
+
+        self.writes = 0
+        self.queue_writes = 0
+        self.songs_written = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'writes': self.writes,
+            'queue_writes': self.queue_writes,
+            'songs_written': self.songs_written,
+        }
+
+    async def _run(self, func: typing.Callable, *args) -> typing.Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    async def save(
+        self, snapshots: typing.List[typing.Tuple[
+            int, dict, float, typing.Optional[QueueUpdate]]]
+    ) -> None:
+        """Writes ``(guild_id, state, position, queue)`` snapshots in one
+        transaction.
+        """
+        if not snapshots:
+            return
+
+        await self._run(self._save, snapshots)
+        self.writes += 1
+        for *_, queue in snapshots:
+            if queue is not None:
+                self.queue_writes += 1
+                self.songs_written += len(queue.entries)
+
+    def _save(self, snapshots) -> None:
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            for guild_id, state, position, queue in snapshots:
+                conn.execute(
+                    'INSERT INTO sessions (guild_id, state, position, '
+                    'saved_at) VALUES (?, ?, ?, ?) ON CONFLICT (guild_id) '
+                    'DO UPDATE SET state = excluded.state, '
+                    'position = excluded.position, '
+                    'saved_at = excluded.saved_at',
+                    (guild_id, json.dumps(state), position, now))
+                if queue is None:
+                    continue
+
+                if queue.replace:
+                    conn.execute('DELETE FROM songs WHERE guild_id = ?',
+                                 (guild_id, ))
+                else:
+                    conn.execute(
+                        'DELETE FROM songs WHERE guild_id = ? AND seq < ?',
+                        (guild_id, queue.head))
+                conn.executemany(
+                    'INSERT OR REPLACE INTO songs (guild_id, seq, entry) '
+                    'VALUES (?, ?, ?)',
+                    [(guild_id, seq, json.dumps(entry, separators=(',', ':')))
+                     for seq, entry in queue.entries])
+
+    async def delete(self, guild_id: int) -> None:
+        await self._run(self._delete, guild_id)
+
+    def _delete(self, guild_id: int) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM sessions WHERE guild_id = ?',
+                         (guild_id, ))
+            conn.execute('DELETE FROM songs WHERE guild_id = ?', (guild_id, ))
+
+    async def load(self, max_age: float) -> typing.List[dict]:
+        """Returns the snapshots saved within the last ``max_age`` seconds
+        and drops the older ones. Snapshots that can't be read are dropped
+        as well.
+        """
+        return await self._run(self._load, max_age)
+
+    def _load(self, max_age: float) -> typing.List[dict]:
+        conn = self._connect()
+        expired = time.time() - max_age
+        with conn:
+            conn.execute(
+                'DELETE FROM songs WHERE guild_id IN (SELECT guild_id FROM '
+                'sessions WHERE saved_at < ?)', (expired, ))
+            conn.execute('DELETE FROM sessions WHERE saved_at < ?',
+                         (expired, ))
+
+        snapshots = []
+        rows = conn.execute(
+            'SELECT guild_id, state, position FROM sessions').fetchall()
+        for guild_id, state, position in rows:
+            songs = conn.execute(
+                'SELECT entry FROM songs WHERE guild_id = ? ORDER BY seq',
+                (guild_id, ))
+            try:
+                snapshots.append({
+                    'guild_id': guild_id,
+                    'state': json.loads(state),
+                    'queue': [json.loads(entry) for entry, in songs],
+                    'position': position,
+                })
+            except ValueError:
+                log.exception('Dropping the unreadable session of %s',
+                              guild_id)
+                self._delete(guild_id)
+        return snapshots
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
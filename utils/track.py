@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import sys, typing
+
+__all__ = ('Track', )
+
+# The only keys of a youtube_dl info dict the bot ever reads. Formats,
+# thumbnails, descriptions, tags and counters are dropped. ``loudness`` and
+# ``peak`` aren't youtube_dl's, they're measured, see utils/loudness.py.
+FIELDS = ('webpage_url', 'id', 'title', 'uploader', 'uploader_url',
+          'upload_date', 'duration', 'thumbnail', 'url', 'loudness', 'peak')
+
+# Signed stream URLs are unique and short-lived, they aren't worth interning.
+_NOT_INTERNED = ('url', )
+
+
+class Track:
+    """The info of a track, immutable and without a ``__dict__``.
+
+    Strings are interned, so that the uploader of a hundred queued songs
+    or a track queued in many guilds is only kept once. ``url`` is the
+    stream URL, it's ``None`` until the track has been resolved.
+    ``loudness`` (LUFS) and ``peak`` (dBTP) are ``None`` until the track
+    has been analyzed.
+    """
+    __slots__ = FIELDS
+
+    def __init__(self,
+                 webpage_url: str,
+                 *,
+                 id: str = None,
+                 title: str = None,
+                 uploader: str = None,
+                 uploader_url: str = None,
+                 upload_date: str = None,
+                 duration: int = None,
+                 thumbnail: str = None,
+                 url: str = None,
+                 loudness: float = None,
+                 peak: float = None):
+        values = locals()
+        for field in FIELDS:
+            value = values[field]
+            if isinstance(value, str) and field not in _NOT_INTERNED:
+                value = sys.intern(value)
+            object.__setattr__(self, field, value)
+
+        if duration is not None:
+            object.__setattr__(self, 'duration', int(duration))
+
+    @classmethod
+    def from_info(cls, info: typing.Mapping[str, typing.Any]) -> Track:
+        """Builds a track from a youtube_dl info dict, other keys are ignored."""
+        return cls(**{
+            field: info[field]
+            for field in FIELDS if info.get(field) is not None
+        })
+
+    def replace(self, **changes: typing.Any) -> Track:
+        """Returns a copy of this track with some fields changed."""
+        fields = self.to_dict()
+        fields.update(changes)
+        return Track(**fields)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            field: getattr(self, field)
+            for field in FIELDS if getattr(self, field) is not None
+        }
+
+    def __setattr__(self, name: str, value: typing.Any):
+        raise AttributeError('Track objects are immutable')
+
+    def __delattr__(self, name: str):
+        raise AttributeError('Track objects are immutable')
+
+    def __reduce__(self):
+        return (_restore, (self.to_dict(), ))
+
+    def __eq__(self, other: typing.Any) -> bool:
+        if not isinstance(other, Track):
+            return NotImplemented
+        return all(
+            getattr(self, field) == getattr(other, field) for field in FIELDS)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in FIELDS))
+
+    def __repr__(self):
+        return '<Track webpage_url={0.webpage_url!r} title={0.title!r}>'.format(
+            self)
+
+
+def _restore(fields: dict) -> Track:
+    return Track(**fields)
@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio, sqlite3, time, typing
+
+from utils.cache import normalize_query
+from utils.track import Track
+
+__all__ = ('TrackStore', )
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tracks (
+    key TEXT PRIMARY KEY,
+    webpage_url TEXT NOT NULL,
+    id TEXT,
+    title TEXT,
+    uploader TEXT,
+    uploader_url TEXT,
+    upload_date TEXT,
+    duration INTEGER,
+    thumbnail TEXT,
+    loudness REAL,
+    peak REAL,
+    last_used REAL NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks (last_used);
+CREATE TABLE IF NOT EXISTS queries (
+    query TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queries_key ON queries (key);
+'''
+
+# Track info columns, in table order.
+FIELDS = ('webpage_url', 'id', 'title', 'uploader', 'uploader_url',
+          'upload_date', 'duration', 'thumbnail', 'loudness', 'peak')
+
+# Measured once and kept when the track is extracted again.
+MEASURED = ('loudness', 'peak')
+
+# Columns added since the first version of the table.
+MIGRATIONS = (('loudness', 'REAL'), ('peak', 'REAL'))
+
+
+class TrackStore:
+    """Track info kept in SQLite so that it survives restarts.
+
+    Stream URLs expire and are never stored, a track found here still has
+    to be resolved before it can be played. All database work happens on a
+    single background thread, writes are batched.
+    """
+    def __init__(self,
+                 path: str,
+                 *,
+                 max_tracks: int = 100000,
+                 max_age: float = 30 * 24 * 3600,
+                 batch_size: int = 100,
+                 flush_interval: float = 5.0,
+                 prune_interval: float = 3600.0):
+        self.path = path
+        self.max_tracks = max_tracks
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='trackstore')
+        self._conn: typing.Optional[sqlite3.Connection] = None
+        self._tracks: typing.Dict[str, dict] = {}
+        self._queries: typing.Dict[str, str] = {}
+        self._flusher: typing.Optional[asyncio.Task] = None
+        self._last_prune = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'pending': len(self._tracks) + len(self._queries),
+        }
+
+    async def _run(self, func: typing.Callable, *args) -> typing.Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            self._migrate(self._conn)
+        return self._conn
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection) -> None:
+        columns = {
+            row[1]
+            for row in conn.execute('PRAGMA table_info(tracks)')
+        }
+        with conn:
+            for column, kind in MIGRATIONS:
+                if column not in columns:
+                    conn.execute('ALTER TABLE tracks ADD COLUMN {} {}'.format(
+                        column, kind))
+
+    async def get(self, query: str) -> typing.Optional[Track]:
+        """Looks up a query or a webpage URL."""
+        key = normalize_query(query)
+        key = self._queries.get(key, key)
+
+        info = self._tracks.get(key)
+        if info is not None:
+            info = Track.from_info(info)
+        else:
+            info = await self._run(self._get, key)
+
+        if info is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # Refreshes last_used so popular tracks aren't pruned.
+        self.put(query, info)
+        return info
+
+    def _get(self, key: str) -> typing.Optional[Track]:
+        conn = self._connect()
+        row = conn.execute('SELECT key FROM queries WHERE query = ?',
+                           (key, )).fetchone()
+        if row is not None:
+            key = row[0]
+
+        row = conn.execute(
+            'SELECT {} FROM tracks WHERE key = ?'.format(', '.join(FIELDS)),
+            (key, )).fetchone()
+        if row is None:
+            return None
+
+        return Track.from_info(dict(zip(FIELDS, row)))
+
+    async def get_loudness(
+        self, webpage_url: str
+    ) -> typing.Optional[typing.Tuple[float, typing.Optional[float]]]:
+        """Returns the measured loudness and peak of a track, if any."""
+        key = normalize_query(webpage_url)
+        info = self._tracks.get(key)
+        if info is not None and info['loudness'] is not None:
+            return info['loudness'], info['peak']
+
+        return await self._run(self._get_loudness, key)
+
+    def _get_loudness(
+        self, key: str
+    ) -> typing.Optional[typing.Tuple[float, typing.Optional[float]]]:
+        row = self._connect().execute(
+            'SELECT loudness, peak FROM tracks WHERE key = ? '
+            'AND loudness IS NOT NULL', (key, )).fetchone()
+        return None if row is None else tuple(row)
+
+    def put(self, query: typing.Optional[str], info: Track) -> None:
+        """Queues ``info`` to be written, mapping ``query`` to it."""
+        key = normalize_query(info.webpage_url)
+        row = {field: getattr(info, field) for field in FIELDS}
+        pending = self._tracks.get(key)
+        if pending is not None:
+            for field in MEASURED:
+                if row[field] is None:
+                    row[field] = pending[field]
+        self._tracks[key] = row
+
+        if query is not None:
+            query = normalize_query(query)
+            if query != key:
+                self._queries[query] = key
+
+        if len(self._tracks) + len(self._queries) >= self.batch_size:
+            self._schedule_flush(0)
+        else:
+            self._schedule_flush(self.flush_interval)
+
+    def _schedule_flush(self, delay: float) -> None:
+        if self._flusher is not None and not self._flusher.done():
+            if delay:
+                return
+            self._flusher.cancel()
+
+        self._flusher = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._tracks and not self._queries:
+            return
+
+        tracks, self._tracks = self._tracks, {}
+        queries, self._queries = self._queries, {}
+        await self._run(self._write, tracks, queries)
+        self.writes += 1
+
+    def _write(self, tracks: typing.Dict[str, dict],
+               queries: typing.Dict[str, str]) -> None:
+        conn = self._connect()
+        now = time.time()
+        columns = ', '.join(FIELDS)
+        updates = ', '.join(
+            '{0} = COALESCE(excluded.{0}, {0})'.format(field)
+            if field in MEASURED else '{0} = excluded.{0}'.format(field)
+            for field in FIELDS)
+
+        with conn:
+            conn.executemany(
+                'INSERT INTO tracks (key, {0}, last_used) '
+                'VALUES (?, {1}, ?) ON CONFLICT (key) DO UPDATE SET {2}, '
+                'last_used = excluded.last_used, uses = uses + 1'.format(
+                    columns, ', '.join('?' * len(FIELDS)), updates),
+                [(key, *(info[field] for field in FIELDS), now)
+                 for key, info in tracks.items()])
+            conn.executemany(
+                'INSERT INTO queries (query, key, last_used) VALUES (?, ?, ?) '
+                'ON CONFLICT (query) DO UPDATE SET key = excluded.key, '
+                'last_used = excluded.last_used',
+                [(query, key, now) for query, key in queries.items()])
+
+        if now - self._last_prune >= self.prune_interval:
+            self._prune(conn, now)
+            self._last_prune = now
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        with conn:
+            conn.execute('DELETE FROM tracks WHERE last_used < ?',
+                         (now - self.max_age, ))
+            conn.execute(
+                'DELETE FROM tracks WHERE key IN (SELECT key FROM tracks '
+                'ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_tracks, ))
+            conn.execute(
+                'DELETE FROM queries WHERE key NOT IN (SELECT key FROM tracks)')
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)